@@ -0,0 +1,200 @@
+# Query latency of chemical_source on a synthetic river network with many headwaters,
+# against the recursive solver it replaced
+# Run from the repository root:
+# python -m benchmarks.bench_chemical_source [headwaters] [queries] [recursive queries]
+import random
+import statistics
+import sys
+import time
+
+from data_struct import Edge, Graph, source_type
+
+
+# Random river tree draining to node 1: every new reach flows into an
+# existing node, and nodes nothing flows into become headwaters
+def build(headwaters: int, seed=0):
+    rng = random.Random(seed)
+    downstream = {1: None}
+    leaves = {1}
+    next_id = 2
+    while len(leaves) < headwaters:
+        parent = rng.choice(list(downstream))
+        downstream[next_id] = parent
+        leaves.discard(parent)
+        leaves.add(next_id)
+        next_id += 1
+
+    graph = Graph()
+    for node_id in downstream:
+        graph.add_node(
+            {
+                "node_id": node_id,
+                "x": rng.randint(0, 650),
+                "y": rng.randint(0, 650),
+                "type": "headwater" if node_id in leaves else "junction",
+            }
+        )
+    for node_id, parent in downstream.items():
+        if parent is not None:
+            graph.add_edge(node_id, Edge(parent))
+    return graph
+
+
+# Observations down one headwater's path, with an off-path reading mixed in
+# for every other query (so the solver has to split the sequence)
+def random_queries(graph: Graph, count: int, seed=0):
+    rng = random.Random(seed)
+    headwaters = graph.get_headwater_nodes_id()
+    nodes = list(graph.adjacency_list)
+    queries = []
+    for query in range(count):
+        path = graph.traverse_to_final_outlet(rng.choice(headwaters))
+        observed = path[1 : 1 + rng.randint(2, 4)]
+        sequence = [(node, 10 - i) for i, node in enumerate(observed)]
+        if query % 2:
+            sequence.append((rng.choice(nodes), rng.randint(1, 10)))
+        queries.append(sequence)
+    return queries
+
+
+# chemical_source as it was before it was solved bottom-up (the baseline): it
+# recursed on the common and difference subsets of the observations, and
+# rebuilt the headwater traversal lists on every call. The 'possible node
+# value' print is left out, and a lone sensor with no headwater near it is
+# skipped rather than failing, as chemical_source does now
+def recursive_chemical_source(graph: Graph, input_sequence):
+    possible_headwaters = []
+    possible_source_pool = []
+    observed_nodes = []
+    for node, conc in input_sequence:
+        observed_nodes.append(node)
+        if graph.data(node).type == source_type:
+            possible_headwaters.append(node)
+
+    headwater_node_traversals = {
+        node_id: graph.traverse_to_final_outlet(node_id)
+        for node_id in graph.get_headwater_nodes_id()
+    }
+    headwater_node_positions = graph.headwater_traversal_positions()
+
+    for node in headwater_node_traversals:
+        if all(item in headwater_node_positions[node] for item in observed_nodes):
+            result = graph.all_contamination_nodes_in_traversal(
+                current_node=node,
+                observed_nodes=observed_nodes,
+                headwater_node_traversals=headwater_node_traversals,
+                input_sequence=input_sequence,
+                headwater_node_positions=headwater_node_positions,
+            )
+            if result is not None:
+                possible_headwaters.append(result)
+            continue
+
+        common_nodes_list, difference_nodes_list = graph.find_common_and_difference(
+            observed_nodes, headwater_node_positions[node]
+        )
+        if len(common_nodes_list) <= 1:
+            continue
+
+        node_index_dict = {item: headwater_node_positions[node][item] for item in common_nodes_list}
+        node_index_dict = dict(sorted(node_index_dict.items(), key=lambda item: item[1]))
+        if not graph.is_incremental_sequence(node_index_dict):
+            for common_node in common_nodes_list:
+                possible_source_pool.extend(
+                    graph.check_direct_connection_to_headwater(common_node, headwater_node_traversals)
+                )
+        possible_source_pool.extend(
+            recursive_chemical_source(
+                graph, graph.get_formatted_input_sequence(input_sequence, common_nodes_list)
+            )
+        )
+
+        if len(difference_nodes_list) == 0:
+            continue
+        if len(difference_nodes_list) == 1:
+            difference_node_id = difference_nodes_list[0]
+            direct_source_list = graph.check_direct_connection_to_headwater(
+                difference_node_id, headwater_node_traversals
+            )
+            if direct_source_list:
+                possible_source_pool.extend(direct_source_list)
+            else:
+                difference_node_data = graph.data(difference_node_id)
+                temp_distance = {}
+                for vertex_id in graph.headwater_in_region(
+                    (difference_node_data.x - 50, difference_node_data.y - 50),
+                    (difference_node_data.x + 50, difference_node_data.y + 50),
+                ):
+                    temp_distance[vertex_id] = graph.path_distance(
+                        difference_node_data, graph.data(vertex_id)
+                    )
+                if temp_distance:
+                    possible_source_pool.append(min(temp_distance, key=temp_distance.get))
+        possible_source_pool.extend(
+            recursive_chemical_source(
+                graph, graph.get_formatted_input_sequence(input_sequence, difference_nodes_list)
+            )
+        )
+
+    if possible_source_pool:
+        sum_of_squared = {}
+        for possible_node in dict.fromkeys(possible_source_pool):
+            temp_distance = {
+                observed_node: graph.path_distance(graph.data(possible_node), graph.data(observed_node))
+                for observed_node in observed_nodes
+            }
+            sum_of_squared[possible_node] = graph.get_sum_of_square(temp_distance)
+        possible_headwaters.append(min(sum_of_squared, key=sum_of_squared.get))
+    return list(dict.fromkeys(possible_headwaters))
+
+
+def run_recursive(graph: Graph, queries: list):
+    latencies = []
+    for sequence in queries:
+        start = time.perf_counter()
+        recursive_chemical_source(graph, sequence)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def run(graph: Graph, queries: list):
+    latencies = []
+    for sequence in queries:
+        start = time.perf_counter()
+        graph.chemical_source(sequence, verbose=False)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(label: str, latencies: list):
+    latencies = sorted(latencies)
+    p95 = latencies[max(int(len(latencies) * 0.95) - 1, 0)]
+    print(
+        f"{label:12} mean {statistics.mean(latencies) * 1000:8.3f} ms"
+        f"  median {statistics.median(latencies) * 1000:8.3f} ms"
+        f"  p95 {p95 * 1000:8.3f} ms"
+    )
+
+
+if __name__ == "__main__":
+    headwaters = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    # The recursive solver takes seconds per query, so only the first few are timed
+    recursive_queries = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    graph = build(headwaters)
+    sequences = random_queries(graph, queries + 1)
+    graph.clear_outlet_cache()
+
+    print(f"{len(graph.adjacency_list)} nodes, {headwaters} headwaters, {queries} queries")
+    # The first query also builds the cached headwater traversals
+    report("first", run(graph, sequences[:1]))
+    report("warm", run(graph, sequences[1:]))
+    report("recursive", run_recursive(graph, sequences[1 : 1 + recursive_queries]))
+    report("warm (same)", run(graph, sequences[1 : 1 + recursive_queries]))
+
+    # Whole batch across worker processes (includes sending each the graph)
+    start = time.perf_counter()
+    results = graph.chemical_source_batch(sequences[1:])
+    print(f"batch        {time.perf_counter() - start:.3f} s total")
+    report("in worker", [result["seconds"] for result in results])
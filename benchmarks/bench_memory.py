@@ -0,0 +1,74 @@
+# Memory used per node and per edge, before and after slotting Vertex/Edge
+# Run from the repository root: python -m benchmarks.bench_memory [edges]
+# (tracemalloc slows allocation down, a 1M edge run takes about a minute)
+import sys
+import tracemalloc
+
+from data_struct import Edge, Graph, Vertex
+
+
+# Vertex and Edge as they were before __slots__ (one __dict__ per instance)
+class DictEdge:
+    def __init__(self, node: int):
+        self.node = node
+        self.weight = None
+        self.flow_rate = None
+        self.next = None
+
+
+class DictVertex:
+    def __init__(self, x: int, y: int, type: str):
+        self.x = x
+        self.y = y
+        self.type = type
+        self.next = None
+        self.tail = None
+        self.degree = 0
+
+
+# Synthetic river network: every node links to the next `degree` nodes
+def build(vertex_class, edge_class, nodes: int, degree: int):
+    graph = Graph()
+    types = ("junction", "headwater", "flowgauge", "Roadjunction")
+    for node_id in range(nodes):
+        # New string per node, like the rows read by csv.DictReader
+        type = "".join(types[node_id % len(types)])
+        graph.adjacency_list[node_id] = vertex_class(node_id % 650, node_id // 650, type)
+    for node_id in range(nodes):
+        graph.add_edges(
+            node_id,
+            (edge_class((node_id + step) % nodes) for step in range(1, degree + 1)),
+        )
+    return graph
+
+
+# Returns bytes allocated for the vertices, then for the edges
+def measure(vertex_class, edge_class, nodes: int, degree: int):
+    tracemalloc.start()
+    graph = build(vertex_class, edge_class, nodes, 0)
+    vertex_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del graph
+
+    tracemalloc.start()
+    graph = build(vertex_class, edge_class, nodes, degree)
+    total_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del graph
+
+    return vertex_bytes, total_bytes - vertex_bytes
+
+
+if __name__ == "__main__":
+    edges = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    degree = 2
+    nodes = edges // degree
+
+    print(f"Synthetic network: {nodes} nodes, {nodes * degree} edges")
+    print(f"{'':10}{'bytes/node':>12}{'bytes/edge':>12}")
+    for label, vertex_class, edge_class in (
+        ("before", DictVertex, DictEdge),
+        ("after", Vertex, Edge),
+    ):
+        vertex_bytes, edge_bytes = measure(vertex_class, edge_class, nodes, degree)
+        print(f"{label:10}{vertex_bytes / nodes:>12.1f}{edge_bytes / (nodes * degree):>12.1f}")
@@ -0,0 +1,101 @@
+# Per-call latency of shortest_path over many consecutive region queries, against
+# re-reading the CSV file on every call as it used to
+# Run from the repository root: python -m benchmarks.bench_region_queries [queries]
+import csv
+import random
+import statistics
+import sys
+import time
+
+from data_struct import (
+    CSV_FILE,
+    Graph,
+    held_karp_tour,
+    heuristic_tour,
+    parse_csv_into_adjacency_list,
+    point_distance,
+)
+
+
+# Random regions of up to 120 x 120 units inside the 650 x 650 map
+def random_regions(count: int, seed=0):
+    rng = random.Random(seed)
+    regions = []
+    for loops in range(count):
+        width, height = rng.randint(40, 120), rng.randint(40, 120)
+        x, y = rng.randint(0, 650 - width), rng.randint(0, 650 - height)
+        regions.append(((x, y), (x + width, y + height)))
+    return regions
+
+
+# shortest_path as it was before it used the loaded graph: the CSV file is
+# read again on every call to find the nodes in the region (the baseline)
+def reread_shortest_path(graph: Graph, top_left, bottom_right, weights=None, time_budget=1.0):
+    nodes_data = {}
+    with open(CSV_FILE, mode="r") as file:
+        for row in csv.DictReader(file):
+            nodes_data[int(row["Node"])] = (float(row["x"]), float(row["y"]))
+    nodes = [
+        node_id
+        for node_id, (x, y) in nodes_data.items()
+        if top_left[0] <= x <= bottom_right[0] and top_left[1] <= y <= bottom_right[1]
+    ]
+
+    cost = []
+    for source in nodes:
+        row = []
+        for destination in nodes:
+            distance = point_distance(*nodes_data[source], *nodes_data[destination])
+            if weights:
+                distance /= weights["water" if graph.is_river(source, destination) else "road"]
+            row.append(distance)
+        cost.append(row)
+
+    if len(nodes) <= 12:
+        order, distance = held_karp_tour(cost)
+    else:
+        order, distance = heuristic_tour(cost, time_budget)
+    return tuple(nodes[i] for i in order), distance
+
+
+def run_reread(graph: Graph, regions: list, weights=None):
+    latencies = []
+    for top_left, bottom_right in regions:
+        start = time.perf_counter()
+        reread_shortest_path(graph, top_left, bottom_right, weights, time_budget=0.05)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def run(graph: Graph, regions: list, weights=None):
+    latencies = []
+    for top_left, bottom_right in regions:
+        start = time.perf_counter()
+        graph.shortest_path(top_left, bottom_right, weights, time_budget=0.05)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(label: str, latencies: list):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(
+        f"{label:20} mean {statistics.mean(latencies) * 1000:8.3f} ms"
+        f"  median {statistics.median(latencies) * 1000:8.3f} ms"
+        f"  p95 {p95 * 1000:8.3f} ms"
+    )
+
+
+if __name__ == "__main__":
+    queries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    graph = Graph()
+    parse_csv_into_adjacency_list(graph)
+    regions = random_regions(queries)
+
+    print(f"{queries} consecutive region queries")
+    weights = {"water": 32, "road": 60}
+    report("re-reading", run_reread(graph, regions))
+    report("in-memory", run(graph, regions))
+    report("re-reading weighted", run_reread(graph, regions, weights))
+    report("in-memory weighted", run(graph, regions, weights))
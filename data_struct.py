@@ -1,6 +1,12 @@
 import math  # For calculating distance
-import itertools  # For path permutations
 import csv
+import os
+import heapq
+import random
+import time
+from array import array  # Compact buffers for FrozenGraph
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 
 # ASSUMPTIONS
 # 1. assuming that the junctions seepage occurs only within the 50 diagonal units of the node junction
@@ -21,6 +27,10 @@ source_type = "headwater"
 
 road_type = {"Roadjunction", "Delamere", "Pine Creek"}
 
+# Some paths connect two 'river nodes' but are not rivers
+# so they are manually black listed
+non_river_blacklist = {(50, 33), (33, 50)}
+
 
 # Class to represent nodes in the Trie
 class TrieNode:
@@ -78,14 +88,30 @@ class Trie:
                 break
         return encoded_word
 
+# Vertex types are interned to small integer codes, so each vertex
+# stores an int instead of its own reference to the type string
+vertex_type_names = []  # Type code -> type name
+vertex_type_codes = {}  # Type name -> type code
+
+
+def intern_vertex_type(type: str):
+    if type not in vertex_type_codes:
+        vertex_type_codes[type] = len(vertex_type_names)
+        vertex_type_names.append(type)
+    return vertex_type_codes[type]
+
+
 # Stores data about an edge in the graph
 class Edge:
-    def __init__(self, node: int):
+    # No per-instance __dict__, since there is one Edge per reach
+    __slots__ = ("node", "weight", "flow_rate", "next")
+
+    def __init__(self, node: int, weight=None, flow_rate=None, next=None):
         self.node = node  # Node that it points towards
-        self.weight = None  # Represents distance approximation
-        self.flow_rate = None  # Flow rate of river
+        self.weight = weight  # Represents distance approximation
+        self.flow_rate = flow_rate  # Flow rate of river
         # Link to next edge in LinkedList
-        self.next = None
+        self.next = next
 
     def __str__(self):
         return f"\nNode: {str(self.node)},\nWeight: {str(self.weight)}, \nFlow_rate: {str(self.flow_rate)}, \nNext: {str(self.next)}\n"
@@ -94,22 +120,333 @@ class Edge:
 # Stores data about a node/vertex in the graph
 # Node ID is not stored here as it will be the key of the adjacency list
 class Vertex:
-    def __init__(self, x: int, y: int, type: str):
+    __slots__ = ("x", "y", "type_code", "next", "tail", "degree")
+
+    def __init__(self, x: int, y: int, type: str, next: Edge = None):
         self.x = x
         self.y = y
-        self.type = type  # Type of location vertex represents
+        self.type_code = intern_vertex_type(type)  # Type of location vertex represents
         # Pointer to the start of the LinkedList, representing the first connected edge
-        self.next = None
+        self.next = next
+        # Pointer to the last edge in the LinkedList, so appending doesn't walk it
+        self.tail = None
+        self.degree = 0  # Number of edges in the LinkedList
+
+        # Count any edges that were passed in
+        edge = next
+        while edge:
+            self.tail = edge
+            self.degree += 1
+            edge = edge.next
+
+    @property
+    def type(self):
+        return vertex_type_names[self.type_code]
+
+    @type.setter
+    def type(self, type: str):
+        self.type_code = intern_vertex_type(type)
+
+    # Pickled with the type name, since type codes only mean something in
+    # the process that interned them
+    def __getstate__(self):
+        return (self.x, self.y, self.type, self.next, self.tail, self.degree)
+
+    def __setstate__(self, state):
+        self.x, self.y, type, self.next, self.tail, self.degree = state
+        self.type_code = intern_vertex_type(type)
 
     def __str__(self):
         return f"\nX: {str(self.x)},\nY: {str(self.y)}, \nType: {str(self.type)}\n"
 
 
+# Uniform grid over vertex coordinates, for region and nearest queries
+# Each vertex type gets its own grid, so type filtered queries skip other types
+class SpatialGrid:
+    def __init__(self, cell_size=50):
+        if cell_size <= 0:
+            raise ValueError("Cell size must be positive")
+        self.cell_size = cell_size
+        # FORMAT|| type: {(cell_x, cell_y): [(order, node_id, x, y), ...]}
+        self.cells = {}
+        self.count = 0  # Number of points added, used as insertion order
+        # Range of cells that hold points, (min_x, min_y, max_x, max_y)
+        self.bounds = None
+
+    def __len__(self):
+        return self.count
+
+    # Returns the cell a coordinate falls in
+    def cell_of(self, x, y):
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    def insert(self, node_id: int, x, y, type: str):
+        cell = self.cell_of(x, y)
+        self.cells.setdefault(type, {}).setdefault(cell, []).append(
+            (self.count, node_id, x, y)
+        )
+        self.count += 1
+
+        if self.bounds is None:
+            self.bounds = (cell[0], cell[1], cell[0], cell[1])
+        else:
+            self.bounds = (
+                min(self.bounds[0], cell[0]),
+                min(self.bounds[1], cell[1]),
+                max(self.bounds[2], cell[0]),
+                max(self.bounds[3], cell[1]),
+            )
+
+    # Returns the grids of the given types (all types if None)
+    def type_grids(self, types=None):
+        if types is None:
+            return list(self.cells.values())
+        if isinstance(types, str):
+            types = (types,)
+        return [self.cells[type] for type in types if type in self.cells]
+
+    # Returns node ids within the rectangle, in the order they were inserted
+    # top_left/bottom_right: (x, y)
+    def in_region(self, top_left: tuple, bottom_right: tuple, types=None):
+        if self.bounds is None:
+            return []
+        # No need to look at cells outside of the filled area
+        min_x, min_y = self.cell_of(top_left[0], top_left[1])
+        max_x, max_y = self.cell_of(bottom_right[0], bottom_right[1])
+        min_x, min_y = max(min_x, self.bounds[0]), max(min_y, self.bounds[1])
+        max_x, max_y = min(max_x, self.bounds[2]), min(max_y, self.bounds[3])
+
+        found = []
+        for grid in self.type_grids(types):
+            for cell_x in range(min_x, max_x + 1):
+                for cell_y in range(min_y, max_y + 1):
+                    for order, node_id, x, y in grid.get((cell_x, cell_y), ()):
+                        if (
+                            top_left[0] <= x <= bottom_right[0]
+                            and top_left[1] <= y <= bottom_right[1]
+                        ):
+                            found.append((order, node_id))
+        found.sort()
+        return [node_id for order, node_id in found]
+
+    # Yields the cells at a ring (square) distance from the centre cell
+    def ring(self, centre: tuple, radius: int):
+        if radius == 0:
+            yield centre
+            return
+        for cell_x in range(centre[0] - radius, centre[0] + radius + 1):
+            yield (cell_x, centre[1] - radius)
+            yield (cell_x, centre[1] + radius)
+        for cell_y in range(centre[1] - radius + 1, centre[1] + radius):
+            yield (centre[0] - radius, cell_y)
+            yield (centre[0] + radius, cell_y)
+
+    # Returns the k closest [(node_id, distance), ...] to (x, y), closest first
+    # Nodes the same distance away are ordered by when they were inserted
+    def nearest(self, x, y, k=1, types=None):
+        grids = self.type_grids(types)
+        if self.bounds is None or not grids or k < 1:
+            return []
+
+        centre = self.cell_of(x, y)
+        # Rings past this radius can't hold any points
+        max_radius = max(
+            abs(centre[0] - self.bounds[0]),
+            abs(centre[0] - self.bounds[2]),
+            abs(centre[1] - self.bounds[1]),
+            abs(centre[1] - self.bounds[3]),
+        )
+
+        # Max-heap (by negating) of the k best found so far
+        best = []  # (-distance, -order, node_id)
+        for radius in range(max_radius + 1):
+            for cell in self.ring(centre, radius):
+                for grid in grids:
+                    for order, node_id, node_x, node_y in grid.get(cell, ()):
+                        distance = point_distance(x, y, node_x, node_y)
+                        if len(best) < k:
+                            heapq.heappush(best, (-distance, -order, node_id))
+                        elif (-distance, -order) > best[0][:2]:
+                            heapq.heapreplace(best, (-distance, -order, node_id))
+            # Every unsearched cell is at least this far away
+            if len(best) == k and -best[0][0] <= radius * self.cell_size:
+                break
+
+        best.sort(reverse=True)
+        return [(node_id, -distance) for distance, order, node_id in best]
+
+    # Returns [(node_id, distance), ...] within radius r of (x, y), closest first
+    def within_radius(self, x, y, r, types=None):
+        if self.bounds is None or r < 0:
+            return []
+        min_x, min_y = self.cell_of(x - r, y - r)
+        max_x, max_y = self.cell_of(x + r, y + r)
+        min_x, min_y = max(min_x, self.bounds[0]), max(min_y, self.bounds[1])
+        max_x, max_y = min(max_x, self.bounds[2]), min(max_y, self.bounds[3])
+
+        found = []
+        for grid in self.type_grids(types):
+            for cell_x in range(min_x, max_x + 1):
+                for cell_y in range(min_y, max_y + 1):
+                    for order, node_id, node_x, node_y in grid.get((cell_x, cell_y), ()):
+                        distance = point_distance(x, y, node_x, node_y)
+                        if distance <= r:
+                            found.append((distance, order, node_id))
+        found.sort()
+        return [(node_id, distance) for distance, order, node_id in found]
+
+
+# Pairwise distances between the nodes of a region, computed once per query
+# Nodes are indexed by their dense position in `nodes` (see `position`)
+class DistanceMatrix:
+    def __init__(self, nodes: list, xs, ys):
+        if not (len(nodes) == len(xs) == len(ys)):
+            raise ValueError("Each node must have one x and one y")
+        self.nodes = list(nodes)  # Position -> node id
+        self.position = {node: i for i, node in enumerate(self.nodes)}
+        self.x = array("d", xs)
+        self.y = array("d", ys)
+
+        # One array per row, rows[i][j] is the distance from position i to j
+        self.rows = []
+        for x1, y1 in zip(self.x, self.y):
+            self.rows.append(
+                array(
+                    "d",
+                    [math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2) for x2, y2 in zip(self.x, self.y)],
+                )
+            )
+
+    def __len__(self):
+        return len(self.nodes)
+
+    # Distance between two node ids
+    def distance(self, node1: int, node2: int):
+        return self.rows[self.position[node1]][self.position[node2]]
+
+    # Distance from every position to a point, e.g. a corner of the region
+    def distances_to(self, x, y):
+        return array("d", [point_distance(node_x, node_y, x, y) for node_x, node_y in zip(self.x, self.y)])
+
+
+# Graph of the strongly connected components of a graph, in CSR form
+# Components are numbered in topological order, so every edge goes from a
+# lower number to a higher one and a single pass over range(len(condensation))
+# visits each component after everything upstream of it, even when the
+# original graph has cycles (e.g. two-way roads)
+class Condensation:
+    def __init__(self, components: list, successors):
+        self.components = [tuple(component) for component in components]
+        self.component_of = {}  # Node id -> component number
+        for number, component in enumerate(self.components):
+            for node in component:
+                self.component_of[node] = number
+
+        # Edges of component c are targets[offsets[c] : offsets[c + 1]]
+        self.offsets = array("l", [0])
+        self.targets = array("l")
+        # 1 if the component holds a cycle (more than one node, or a self loop)
+        self.cyclic = array("B")
+        for number, component in enumerate(self.components):
+            targets = {}
+            cyclic = len(component) > 1
+            for node in component:
+                for neighbor in successors(node):
+                    target = self.component_of.get(neighbor)
+                    if target is None:
+                        continue
+                    if target == number:
+                        cyclic = True
+                    else:
+                        targets[target] = None
+            for target in targets:
+                if target < number:
+                    raise ValueError("Components must be in topological order")
+                self.targets.append(target)
+            self.offsets.append(len(self.targets))
+            self.cyclic.append(cyclic)
+
+    # Number of components
+    def __len__(self):
+        return len(self.components)
+
+    # Component number of a node id
+    def component(self, node_id: int):
+        return self.component_of[node_id]
+
+    # Yields the component numbers component c has edges towards
+    def successors(self, c: int):
+        for slot in range(self.offsets[c], self.offsets[c + 1]):
+            yield self.targets[slot]
+
+
 class Graph:
-    def __init__(self):
+    def __init__(self, cell_size=50):
         # Dictionary that stores the adjacency list representation
         # FORMAT|| node_id: vertex_data -> edge1 -> edge2...
         self.adjacency_list = {}
+        # Grid over the vertices, for region and nearest queries
+        self.spatial_index = SpatialGrid(cell_size)
+        # Region distance matrices kept for reuse, keyed by the region's nodes
+        # Holds at most distance_cache_size, least recently used dropped first
+        self.distance_cache = {}
+        self.distance_cache_size = 4
+        # Incoming edges of each node, updated by add_edge
+        # Only the source is kept (once per edge), its edge is found by walking
+        # the source's LinkedList, so the index costs one list slot per edge
+        # FORMAT|| node_id: [source_id, ...]
+        self.reverse_adjacency = {}
+        # is_river's answer for each (source type code, destination type code),
+        # keyed on the types so retyping a Vertex can't leave a stale answer
+        self.river_type_cache = {}
+        # Result of river_topological_order, None until worked out
+        self.topological_cache = None
+        self.topological_position = {}  # Node -> index in topological_cache
+        # Flow through each river node, None until populate_flow_rate is run
+        # Once set, changes to edges and sources update flows incrementally
+        self.node_flow = None
+        self.source_flow = 1  # Flow of a headwater, unless set in source_flows
+        self.source_flows = {}  # Node -> flow starting at that node
+        # Rivers are traced down to these nodes by traverse_to_final_outlet
+        self.outlets = (1,)
+        self.outlet_trees = {}  # Outlets -> result of outlet_tree
+        self.outlet_paths = {}  # (outlets, node) -> path from node to an outlet
+        self.traversal_lists = None  # Result of headwater_traversals
+        self.traversal_positions = None  # Result of headwater_traversal_positions
+        self.traversal_index = None  # Result of headwater_traversal_index
+
+    # Pickled with each LinkedList flattened, as pickle would otherwise recurse
+    # once per edge down the Edge.next chain
+    # river_type_cache is keyed on this process's type codes, so isn't pickled
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["adjacency_list"] = [
+            (
+                node_id,
+                vertex.x,
+                vertex.y,
+                vertex.type,
+                [(edge.node, edge.weight, edge.flow_rate) for edge in self.edges(node_id)],
+            )
+            for node_id, vertex in self.adjacency_list.items()
+        ]
+        state["river_type_cache"] = {}
+        return state
+
+    def __setstate__(self, state):
+        nodes = state.pop("adjacency_list")
+        self.__dict__.update(state)
+        self.adjacency_list = {}
+        for node_id, x, y, type, edges in nodes:
+            vertex = Vertex(x, y, type)
+            tail_edge = vertex
+            for node, weight, flow_rate in edges:
+                tail_edge.next = Edge(node, weight, flow_rate)
+                tail_edge = tail_edge.next
+            if tail_edge is not vertex:
+                vertex.tail = tail_edge
+            vertex.degree = len(edges)
+            self.adjacency_list[node_id] = vertex
 
     def add_node(self, node_data: dict):
         # If node has already been added
@@ -122,28 +459,170 @@ class Graph:
         self.adjacency_list[node_data["node_id"]] = Vertex(
             node_data["x"], node_data["y"], node_data["type"]
         )
+        self.spatial_index.insert(
+            node_data["node_id"], node_data["x"], node_data["y"], node_data["type"]
+        )
+        self.distance_cache.clear()
+        self.clear_outlet_cache()
+
+        # Node has no edges yet, so it can go at the end of the river order
+        node_id = node_data["node_id"]
+        if self.data(node_id).type in river_types:
+            if self.topological_cache is not None:
+                self.topological_position[node_id] = len(self.topological_cache)
+                self.topological_cache += (node_id,)
+            if self.node_flow is not None:
+                # Edges may already point at the node, so take in their flow
+                node_flow = self.base_flow(node_id)
+                for source_id, edge in self.upstream_river_edges(node_id):
+                    edge.flow_rate = self.node_flow.get(source_id, 0)
+                    node_flow += edge.flow_rate
+                self.node_flow[node_id] = node_flow
+
+    # Rebuilds the spatial index, needed if vertices are changed directly
+    def rebuild_spatial_index(self):
+        self.distance_cache.clear()
+        self.spatial_index = SpatialGrid(self.spatial_index.cell_size)
+        for node_id, vertex in self.adjacency_list.items():
+            self.spatial_index.insert(node_id, vertex.x, vertex.y, vertex.type)
 
     def add_edge(self, source_id: int, edge_to_add: Edge):
+        self.add_edges(source_id, (edge_to_add,))
+
+    # Links a batch of edges onto the end of the source's LinkedList in one pass
+    # edges_to_add: Edge objects, or node ids to point towards
+    def add_edges(self, source_id: int, edges_to_add):
+        source = self.adjacency_list.get(source_id)
         # If source node doesn't exist
-        if self.adjacency_list.get(source_id) is None:
+        if source is None:
             raise KeyError("\nSource Node '" + str(source_id) + "' isn't in the graph")
 
-        # Get the end of the source id's LinkedList
-        tail_edge = LL_as_array(self.data(source_id))[-1]
-        # Add to end
-        tail_edge.next = edge_to_add
+        # Start at the end of the LinkedList (the vertex itself if it has no edges)
+        tail_edge = source.tail if source.tail else source
+        new_edges = []
+        for edge in edges_to_add:
+            if not isinstance(edge, Edge):
+                edge = Edge(edge)
+            # Add to end
+            tail_edge.next = edge
+            # Edge may already be the head of a chain, so step to its end
+            while tail_edge.next:
+                tail_edge = tail_edge.next
+                source.degree += 1
+                self.reverse_adjacency.setdefault(tail_edge.node, []).append(source_id)
+                new_edges.append(tail_edge)
+
+        if tail_edge is not source:
+            source.tail = tail_edge
+        self.clear_outlet_cache()
+
+        # Nothing else to update, unless the river order or flows are in use
+        if self.topological_cache is None and self.node_flow is None:
+            return
+
+        # Check the new edges against the river order and flows
+        flow_deltas = {}
+        for edge in new_edges:
+            # Can't be a river yet, if it points to a node not added yet
+            if self.data(edge.node) is None:
+                self.topological_cache = None
+                continue
+            if not self.is_river(source_id, edge.node):
+                continue
+            position = self.topological_position
+            # Order is only still valid if the river flows forward in it
+            if not (
+                self.topological_cache is not None
+                and source_id in position
+                and edge.node in position
+                and position[source_id] < position[edge.node]
+            ):
+                self.topological_cache = None
+            if self.node_flow is not None:
+                edge.flow_rate = self.node_flow.get(source_id, 0)
+                flow_deltas[edge.node] = flow_deltas.get(edge.node, 0) + edge.flow_rate
+
+        # Pass the new flow downstream, once for the whole batch
+        if flow_deltas:
+            self.update_flow(flow_deltas)
+
+    # Unlinks the first edge from source to destination, and returns it
+    def remove_edge(self, source_id: int, destination_id: int):
+        source = self.adjacency_list.get(source_id)
+        if source is None:
+            raise KeyError("\nSource Node '" + str(source_id) + "' isn't in the graph")
+
+        # Find the edge, and the step before it in the LinkedList
+        previous = source
+        while previous.next and previous.next.node != destination_id:
+            previous = previous.next
+        edge = previous.next
+        if edge is None:
+            raise KeyError(
+                "\nNo edge from '" + str(source_id) + "' to '" + str(destination_id) + "'"
+            )
+
+        previous.next = edge.next
+        edge.next = None
+        if source.tail is edge:
+            source.tail = previous if previous is not source else None
+        source.degree -= 1
+        self.clear_outlet_cache()
+        self.reverse_adjacency[destination_id].remove(source_id)
+
+        if not self.is_river(source_id, destination_id):
+            return edge
+        position = self.topological_position
+        if self.topological_cache is not None and (
+            source_id not in position or destination_id not in position
+        ):
+            # River was on (or below) a cycle, which it may have broken, so the
+            # order needs rebuilding. Nodes left out of the order never had a
+            # flow to push on, so flows are swept again as well
+            self.topological_cache = None
+            if self.node_flow is not None:
+                self.populate_flow_rate(self.source_flow)
+        elif self.node_flow is not None:
+            # Removing a river between ordered nodes keeps the order valid,
+            # but takes its flow away
+            self.update_flow({destination_id: -(edge.flow_rate or 0)})
+        return edge
 
     # Returns the vertex data, easier than keying the adj. list
     def data(self, node_id: int):
         return self.adjacency_list.get(node_id)
 
+    # Yields each edge connected to a node, walking the LinkedList lazily
+    def edges(self, node_id: int):
+        edge = self.data(node_id).next
+        while edge:
+            yield edge
+            edge = edge.next
+
+    # Yields the node ids a node has edges towards
+    def neighbors(self, node_id: int):
+        for edge in self.edges(node_id):
+            yield edge.node
+
+    # Yields the node ids with an edge towards a node (once per edge)
+    def predecessors(self, node_id: int):
+        yield from self.reverse_adjacency.get(node_id, ())
+
+    # Yields (source_id, edge) for each river flowing into a node
+    def upstream_river_edges(self, node_id: int):
+        for source_id in dict.fromkeys(self.reverse_adjacency.get(node_id, ())):
+            if self.is_river(source_id, node_id):
+                for edge in self.edges(source_id):
+                    if edge.node == node_id:
+                        yield source_id, edge
+
     def check_edge(self, source_id: int, destination_id: int):
         # If source node doesn't exist
         if not self.adjacency_list.get(source_id):
             return False
 
         # Search all edges connected to our source
-        for connected_edge in LL_as_array(self.data(source_id))[1:]:
+        for connected_edge in self.edges(source_id):
             if connected_edge.node == destination_id:
                 return True
         # If couldn't find it, it isn't connected
@@ -155,38 +634,26 @@ class Graph:
         if len(top_left) != 2 or len(bottom_right) != 2:
             raise ValueError("Region courner(s) must have two arguments (x, y)")
 
-        in_region = []  # All nodes found within region
-        for node in self.adjacency_list:
-            if (
-                self.data(node).x >= top_left[0]
-                and self.data(node).x <= bottom_right[0]
-            ) and (
-                self.data(node).y >= top_left[1]
-                and self.data(node).y <= bottom_right[1]
-            ):
-                in_region.append(node)
-
-        return in_region
+        return self.spatial_index.in_region(top_left, bottom_right)
 
     def is_river(self, source: int, destination: int):
-        # Some paths connect two 'river nodes' but are not rivers
-        # so they are manually black listed
-        non_river_blacklist = set([(50, 33), (33, 50)])
-        # Both nodes must be river types
-        if (self.data(destination).type not in river_types) or (
-            self.data(source).type not in river_types
-        ):
-            return False
-        # Rivers can't flow towards a source
-        if self.data(destination).type == source_type:
+        source_data, destination_data = self.data(source), self.data(destination)
+        # Can't be a river yet, if it points to a node not added yet
+        if source_data is None or destination_data is None:
             return False
-
+        key = (source_data.type_code, destination_data.type_code)
+        if key not in self.river_type_cache:
+            self.river_type_cache[key] = is_river_kind(
+                vertex_type_names[key[0]], vertex_type_names[key[1]]
+            )
         # Skip blacklisted paths
-        if (source, destination) in non_river_blacklist:
-            return False
+        return self.river_type_cache[key] and (source, destination) not in non_river_blacklist
 
-        # If it didn't fail the prevous test, it must be a river
-        return True
+    # Yields each edge of a node that is a river
+    def river_edges(self, node_id: int):
+        for edge in self.edges(node_id):
+            if self.is_river(node_id, edge.node):
+                yield edge
 
     def is_junction(self, node: int):
         return self.data(node).type == "junction"
@@ -205,7 +672,7 @@ class Graph:
         for node in self.adjacency_list:
             print(str(node), end="")  # Start of path
             # Iterate over all edges
-            for edge in LL_as_array(self.data(node))[1:]:
+            for edge in self.edges(node):
                 print(" -> " + str(edge.node), end="")
             # Ends when pointing to null
             print(" -> None")
@@ -214,7 +681,7 @@ class Graph:
         # Iterate over all nodes
         for node in self.adjacency_list:
             # Iterate over that node's edges
-            for edge in LL_as_array(self.data(node))[1:]:
+            for edge in self.edges(node):
                 # Calculate the lenght of path from head node, to connected node
                 path_lenght = self.path_distance(self.data(node), self.data(edge.node))
                 # Set the edge's weight to that
@@ -224,91 +691,271 @@ class Graph:
     def path_distance(self, node1: Vertex, node2: Vertex):
         return math.sqrt((node2.x - node1.x) ** 2 + (node2.y - node1.y) ** 2)
 
-    def populate_flow_rate(self):
-        source_flow = 1  # Assume flow
-
-        # Find the number of incoming rivers for every water node
-        # and add all source nodes into the search queue for later
-        search_queue = []
-        incoming_rivers = {}  # Count of incoming river edges
-        incoming_flow = {}  # Running sum of incoming flow to a node
+    # Returns the DistanceMatrix between the given nodes
+    # reuse: keep it so later queries over the same nodes don't recompute it
+    def distance_matrix(self, nodes: list, reuse=False):
+        key = tuple(nodes)
+        if key in self.distance_cache:
+            # Move to the end, as the most recently used
+            matrix = self.distance_cache.pop(key)
+            self.distance_cache[key] = matrix
+            return matrix
+
+        matrix = DistanceMatrix(
+            key, [self.data(node).x for node in key], [self.data(node).y for node in key]
+        )
+        if reuse:
+            self.distance_cache[key] = matrix
+            # Dicts keep insertion order, so the first key is the least recently used
+            while len(self.distance_cache) > self.distance_cache_size:
+                del self.distance_cache[next(iter(self.distance_cache))]
+        return matrix
+
+    # Returns river nodes in topological order (every river flows from an
+    # earlier node to a later one), using Kahn's algorithm
+    # Nodes on a river cycle can never be reached, so are left out
+    def river_topological_order(self):
+        if self.topological_cache is not None:
+            return self.topological_cache
+
+        # Count the rivers flowing into each river node
+        incoming_rivers = {}
+        search_queue = deque()
         for node in self.adjacency_list:
             # No need to search further if node can't be a river
             if self.data(node).type not in river_types:
                 continue
-            # Add source nodes to start BFS at later
-            if self.data(node).type == source_type:
-                incoming_flow[node] = source_flow
+            incoming_rivers[node] = sum(1 for river in self.upstream_river_edges(node))
+            # Nothing flows in, so it can go first
+            if incoming_rivers[node] == 0:
                 search_queue.append(node)
 
-            # Iterate over all node's edges
-            for edge in LL_as_array(self.data(node))[1:]:
-                # Ignore non-rivers
-                if not self.is_river(node, edge.node):
-                    continue
-
-                # Initialize running count, if not done so
-                if not incoming_rivers.get(edge.node):
-                    incoming_rivers[edge.node] = 0
-                # Since there is a incoming node
-                incoming_rivers[edge.node] += 1
-
-        # Breadth-first-search all edges, starting at source nodes
-        # Only add node to queue if all incoming edges already searched
+        # Only add node to queue once all incoming rivers are ordered
+        order = []
         while search_queue:
-            search_node = search_queue[0]  # Node is from end of queue
-            for edge in LL_as_array(self.data(search_node))[1:]:
-                # Skip non-rivers
-                if not self.is_river(search_node, edge.node):
-                    continue
+            search_node = search_queue.popleft()
+            order.append(search_node)
+            for edge in self.river_edges(search_node):
+                incoming_rivers[edge.node] -= 1
+                if incoming_rivers[edge.node] == 0:
+                    search_queue.append(edge.node)
 
-                # Set flow of edge
-                edge.flow_rate = incoming_flow[search_node]
-                # Initialize edge's running count, if not done so
-                if not (incoming_flow.get(edge.node)):
-                    incoming_flow[edge.node] = 0
-                # Add edges flow to nodes running sum of flow
-                incoming_flow[edge.node] += edge.flow_rate
+        self.topological_cache = tuple(order)
+        self.topological_position = {node: i for i, node in enumerate(order)}
+        return self.topological_cache
 
-                # Since we visited it, remove it
-                incoming_rivers[edge.node] -= 1
+    # Flow that starts at a node, rather than flowing into it
+    def base_flow(self, node_id: int):
+        if node_id in self.source_flows:
+            return self.source_flows[node_id]
+        if self.data(node_id).type == source_type:
+            return self.source_flow
+        return 0
 
-                # print(str(search_node) + " =("+str(edge.flow_rate)+")=> " + str(edge.node))
+    def populate_flow_rate(self, source_flow=1):
+        self.source_flow = source_flow  # Assume flow
 
-                # Search it next, if we visted all incoming nodes
-                if incoming_rivers[edge.node] == 0:
-                    search_queue.append(edge.node)
+        # Sweep rivers in topological order, so all flow into a node is
+        # known before its outgoing rivers are set
+        incoming_flow = {}  # Running sum of incoming flow to a node
+        self.node_flow = {}
+        for node in self.river_topological_order():
+            # Flow starts at sources
+            node_flow = incoming_flow.pop(node, 0) + self.base_flow(node)
+            self.node_flow[node] = node_flow
+            for edge in self.river_edges(node):
+                # Set flow of edge
+                edge.flow_rate = node_flow
+                # Add edges flow to nodes running sum of flow
+                incoming_flow[edge.node] = incoming_flow.get(edge.node, 0) + edge.flow_rate
+
+    # Works out how a change in flow at some nodes changes flow downstream,
+    # without changing the graph
+    # node_deltas: {node: change in flow starting at node}
+    # Returns {node: change in flow through node} for the downstream cone only
+    def flow_deltas(self, node_deltas: dict):
+        return self.downstream_flow_changes(node_deltas)[0]
+
+    # Core of flow_deltas and simulate_dams, doesn't change the graph
+    # dammed: {node: edge} river edges that carry no flow at all
+    # Returns ({node: change in flow through node}, [(source, edge, change in edge flow)])
+    def downstream_flow_changes(self, node_deltas: dict, dammed=None):
+        self.river_topological_order()
+        position = self.topological_position
+        dammed = dammed or {}
+
+        # Visit nodes in topological order, so every change flowing into a
+        # node is added up before it is passed further down
+        pending = {}
+        search_heap = []
+        for node in list(node_deltas) + list(dammed):
+            if node in position and node not in pending:
+                heapq.heappush(search_heap, (position[node], node))
+                pending[node] = 0
+        for node, delta in node_deltas.items():
+            if node in pending:
+                pending[node] += delta
+
+        changed_nodes = {}
+        changed_edges = []
+        while search_heap:
+            search_position, node = heapq.heappop(search_heap)
+            delta = pending.pop(node)
+            if delta == 0 and node not in dammed:
+                continue
+            if delta != 0:
+                changed_nodes[node] = delta
+
+            for edge in self.river_edges(node):
+                edge_delta = delta
+                # A dammed river loses all of its flow, whatever flows in
+                if dammed.get(node) is edge:
+                    edge_delta = -(edge.flow_rate or 0)
+                if edge_delta == 0:
+                    continue
+                changed_edges.append((node, edge, edge_delta))
 
-            # Since we set all outgoing edges, we don't need it anymore
-            incoming_flow.pop(search_node)
-            search_queue.pop(0)  # Move the queue foward by one
+                if edge.node not in position:
+                    continue
+                if edge.node not in pending:
+                    heapq.heappush(search_heap, (position[edge.node], edge.node))
+                    pending[edge.node] = 0
+                pending[edge.node] += edge_delta
+        return changed_nodes, changed_edges
+
+    # Returns (junction, edge) for the river a dam placed near (x, y) would block
+    # Edge is None if the closest junction isn't on a river
+    def dam_site(self, x, y):
+        junction = self.find_closest_junction(x, y)
+        if junction is None:
+            return None, None
+        # The junction's first river is the one that gets dammed
+        return junction, next(self.river_edges(junction), None)
+
+    # Works out the change in flow of every river downstream of a set of dams,
+    # without changing the graph (a dam at (x, y) blocks the closest junction's river)
+    # Returns {"dammed": [(junction, destination), ...],
+    #          "edge_deltas": {(source, destination): change in flow}}
+    def simulate_dams(self, dam_locations):
+        if self.node_flow is None:
+            raise ValueError("Flow rates haven't been populated yet")
+
+        dammed = {}
+        for x, y in dam_locations:
+            junction, edge = self.dam_site(x, y)
+            if edge is not None:
+                dammed[junction] = edge
+
+        changed_nodes, changed_edges = self.downstream_flow_changes({}, dammed)
+        edge_deltas = {}
+        for source, edge, delta in changed_edges:
+            edge_deltas[(source, edge.node)] = edge_deltas.get((source, edge.node), 0) + delta
+        return {
+            "dammed": [(junction, edge.node) for junction, edge in dammed.items()],
+            "edge_deltas": edge_deltas,
+        }
 
-    # Return junctions in region in order of flow rate (highest to lowest)
-    def junction_sort(self, top_left: tuple, bottom_right: tuple):
-        # Dictionary of all junctions's flow rate withn a given range
-        verticies_dict = {}
-        for node in self.vertices_in_region(top_left, bottom_right):
+    # simulate_dams for each list of dam locations, results are in the same order
+    def simulate_dam_scenarios(self, scenarios):
+        return [self.simulate_dams(dam_locations) for dam_locations in scenarios]
+
+    # Applies a change in flow at some nodes, updating only the downstream cone
+    # Returns {node: change in flow through node}
+    def update_flow(self, node_deltas: dict):
+        if self.node_flow is None:
+            raise ValueError("Flow rates haven't been populated yet")
+
+        changed = self.flow_deltas(node_deltas)
+        for node, delta in changed.items():
+            self.node_flow[node] = self.node_flow.get(node, 0) + delta
+            for edge in self.river_edges(node):
+                edge.flow_rate = self.node_flow[node]
+        return changed
+
+    # Sets the flow starting at a node (e.g. a new or changed headwater)
+    # and updates flow downstream of it
+    def set_source_flow(self, node_id: int, flow):
+        if self.data(node_id) is None:
+            raise KeyError("\nNode '" + str(node_id) + "' isn't in the graph")
+
+        delta = flow - self.base_flow(node_id)
+        self.source_flows[node_id] = flow
+        if self.node_flow is not None:
+            return self.update_flow({node_id: delta})
+        return {}
+
+    # Returns river nodes (other than sources) with an outgoing river, within
+    # the region, or the whole graph if no region is given
+    def river_junctions_in_region(self, top_left: tuple = None, bottom_right: tuple = None):
+        if top_left is None or bottom_right is None:
+            nodes = self.adjacency_list
+        else:
+            nodes = self.vertices_in_region(top_left, bottom_right)
+
+        junctions = []
+        for node in nodes:
             # Ignore non-junction sources
             if self.data(node).type not in river_types:
                 continue
             # Source isn't a junction
             if self.data(node).type == source_type:
                 continue
+            # Must flow somewhere
+            if next(self.river_edges(node), None) is None:
+                continue
+            junctions.append(node)
+        return junctions
 
-            for edge in LL_as_array(self.data(node))[1:]:
-                # Ignore non-rivers
-                if not (self.is_river(node, edge.node)):
-                    continue
-
+    # Return junctions in region in order of flow rate (highest to lowest)
+    def junction_sort(self, top_left: tuple, bottom_right: tuple):
+        # Dictionary of all junctions's flow rate withn a given range
+        verticies_dict = {}
+        for node in self.river_junctions_in_region(top_left, bottom_right):
+            for edge in self.river_edges(node):
                 verticies_dict[node] = edge.flow_rate
         print(verticies_dict)
         # Return sorted in reverse order (highest to lowest)
         return MergedSort_Dict(verticies_dict)[::-1]
 
+    # Scores every junction as a dam site, by the total flow reduction over all
+    # rivers downstream of it (damming its first river, as simulate_dams does)
+    # region: (top_left, bottom_right) to only score junctions in it
+    # Returns [(junction, flow reduction), ...] highest first, at most top_k long
+    def rank_dam_sites(self, region=None, top_k=None):
+        if self.node_flow is None:
+            raise ValueError("Flow rates haven't been populated yet")
+        order = self.river_topological_order()
+
+        # Cutting flow f into a node reduces each river below it by f once per
+        # path to it, so the total reduction is f * paths_below[node]
+        # Worked out for every node in one pass, from the outlet up
+        paths_below = {}
+        for node in reversed(order):
+            paths = 0
+            for edge in self.river_edges(node):
+                # Nodes outside the order (on a cycle) aren't followed further
+                paths += 1 + paths_below.get(edge.node, 0)
+            paths_below[node] = paths
+
+        if region is None:
+            junctions = self.river_junctions_in_region()
+        else:
+            junctions = self.river_junctions_in_region(region[0], region[1])
+
+        reductions = {}
+        for junction in junctions:
+            edge = next(self.river_edges(junction))
+            # The dammed river loses its flow, then so does everything below
+            reductions[junction] = (edge.flow_rate or 0) * (1 + paths_below.get(edge.node, 0))
+
+        # Highest reduction first, ties keep the junction order
+        ranked = sorted(reductions.items(), key=lambda item: -item[1])
+        return ranked if top_k is None else ranked[:top_k]
+
     # Prints reduction in flow rate at each junction along the river
     def new_flow(self, dam_x: int, dam_y: int):
         # get the closest junction type node to the coordinate
-        junction_to_dam = self.find_closest_junction(dam_x, dam_y)
+        junction_to_dam, edge_to_dam = self.dam_site(dam_x, dam_y)
         # if the junction doesn't exist, exit the function
         if not (self.data(junction_to_dam)):
             print("Junction doesn't exist")
@@ -317,74 +964,51 @@ class Graph:
         # print the obtained junction node
         print(f"The junction node to be dammed is: {junction_to_dam}")
 
-        # Find where the junctions flows towards
-        junctions_dest = None
-        # iterate over the adjacent edges
-        for edge in LL_as_array(self.data(junction_to_dam))[1:]:
-            # if the junciton node and the adjacent node is a river
-            if self.is_river(junction_to_dam, edge.node):
-                # assign the edge adjacent node to the junctions_dest
-                junctions_dest = edge.node
-                # exit the loop
-                break
-
         # if no junciton destination is not found
-        if not (junctions_dest):
+        if edge_to_dam is None:
             # print the message and exit function
             print("Node isn't part of a river")
             return
 
-        # Find the edge to dam
-        # iterate the adjacent edges for the junciton dam
-        for edge in LL_as_array(self.data(junction_to_dam))[1:]:
-            # if the edge node id and destination node are same
-            if edge.node == junctions_dest:
-                # assign the edge to edge for the dam
-                edge_to_dam = edge
-
-        # Used for reducing flow rate of proceding rivers
-        pre_dam_flow = edge_to_dam.flow_rate
-        # Dam edge, assume stops all flow
-        # edge_to_dam.flow_rate = 0
-
         # print the amount of flow decreased
-        print("The following junctions have a decreased flow of: " + str(pre_dam_flow))
+        print("The following junctions have a decreased flow of: " + str(edge_to_dam.flow_rate))
+
+        # Work out the new flows without changing the graph
+        edge_deltas = self.simulate_dams([(dam_x, dam_y)])["edge_deltas"]
 
         # Traverse down river unill reaching end
         river_path = self.traverse_to_final_outlet(edge_to_dam.node)
         # For ever node that has a proceding node
         for i in range(len(river_path) - 1):
-            for edge in LL_as_array(self.data(river_path[i]))[1:]:
+            for edge in self.edges(river_path[i]):
                 # If edge dosen't go to next step in river, skip it
                 if edge.node != river_path[i + 1]:
                     continue
-                # Reduce flow by the amount provided pre-damming
-                # edge.flow_rate -= pre_dam_flow
-                new_flow_rate = edge.flow_rate - pre_dam_flow
+                new_flow_rate = edge.flow_rate + edge_deltas.get((river_path[i], edge.node), 0)
                 print(str(river_path[i]) + " (new flow: " + str(new_flow_rate) + ")")
 
     # funciton to find the closest "junction" node to a given x and y coordinate
     def find_closest_junction(self, x, y):
-        # Initialize a variable to store the closest junction node ID
-        closest_junction = None
-        # Initialize a variable to store the closest distance (set to positive infinity)
-        closest_distance = float("inf")
+        closest = self.nearest(x, y, 1, types=("junction",))
+        # return the node id of the closest junction
+        return closest[0][0] if closest else None
 
-        # Iterate through all nodes in the adjacency list
-        for node_id in self.adjacency_list:
-            # Get the data for the current node
-            node = self.data(node_id)
+    # Returns the k closest [(node_id, distance), ...] to (x, y), closest first
+    # types: vertex types to include (all types if None)
+    def nearest(self, x, y, k=1, types=None):
+        return self.spatial_index.nearest(x, y, k, types)
 
-            # Check if the node is a junction and calculate the distance
-            if node.type == "junction":
-                distance = self.path_distance(Vertex(x, y, ""), node)
+    # Returns [(node_id, distance), ...] within radius r of (x, y), closest first
+    def within_radius(self, x, y, r, types=None):
+        return self.spatial_index.within_radius(x, y, r, types)
 
-                # Update the closest junction if a closer one is found
-                if distance < closest_distance:
-                    closest_distance = distance
-                    closest_junction = node_id
-        # return the node id of the closest junction
-        return closest_junction
+    # nearest() for every (x, y) in points, returns a list of results in the same order
+    def nearest_batch(self, points, k=1, types=None):
+        return [self.spatial_index.nearest(x, y, k, types) for x, y in points]
+
+    # within_radius() for every (x, y) in points, returns a list of results in the same order
+    def within_radius_batch(self, points, r, types=None):
+        return [self.spatial_index.within_radius(x, y, r, types) for x, y in points]
 
     # function to print the flow rate of each edge in the adjacency list
     def print_flow_rate(self):
@@ -392,138 +1016,87 @@ class Graph:
         for node in self.adjacency_list:
             print(str(node), end="")  # Start of path
             # Iterate over all edges
-            for edge in LL_as_array(self.data(node))[1:]:
+            for edge in self.edges(node):
                 # print(" -> " + str(edge.node), end="")
                 print(f" -> ({edge.node},{edge.flow_rate})", end="")
             # Ends when pointing to null
             print(" -> None")
 
-    # Calculate "shortest" path with a exhaustive search but limiting the number of paths
-    def shortest_path_search(self, top_left: tuple, bottom_right: tuple, weights=None):
-        # Read CSV file
-        nodes_data = {}
-        with open("water_data.csv", mode="r") as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                node_id = int(row["Node"])
-                x = float(row["x"])
-                y = float(row["y"])
-                linked_ids = [
-                    int(linked) for linked in row["linked"].split(",") if linked != ""
-                ]
-                nodes_data[node_id] = {
-                    "x": x,
-                    "y": y,
-                    "linked": linked_ids,
-                    "type": row["type"],
-                }
-
-        # X, Y range
-        x_min, y_min = top_left
-        x_max, y_max = bottom_right
-
-        # Filter nodes within the specified range
-        nodes_in_range = {
-            node_id: node_info
-            for node_id, node_info in nodes_data.items()
-            if x_min <= node_info["x"] <= x_max and y_min <= node_info["y"] <= y_max
-        }
+    # Calculate shortest round trip visiting every node in the region
+    # Exact (Held-Karp) for up to exact_limit nodes, otherwise insertion + local search
+    # for at most time_budget seconds. Returns (path, distance)
+    def shortest_path(
+        self,
+        top_left: tuple,
+        bottom_right: tuple,
+        weights=None,
+        time_budget=1.0,
+        exact_limit=12,
+        reuse_distances=False,
+    ):
+        # Use the loaded graph, no need to read the file again
+        nodes = self.vertices_in_region(top_left, bottom_right)
+        matrix = self.distance_matrix(nodes, reuse_distances)
+
+        # Cost of travelling from nodes[i] to nodes[j]
+        cost = matrix.rows
+        # If there is weights
+        if weights:
+            cost = []
+            for source, row in zip(nodes, matrix.rows):
+                cost.append(
+                    [
+                        # Scale by river or road weight
+                        distance / weights["water" if self.is_river(source, destination) else "road"]
+                        for destination, distance in zip(nodes, row)
+                    ]
+                )
 
-        # Generate all possible path
-        permutations = itertools.permutations(nodes_in_range.keys())
+        if len(nodes) <= exact_limit:
+            order, distance = held_karp_tour(cost)
+        else:
+            order, distance = heuristic_tour(cost, time_budget)
 
-        # Tracking the best path and its distance
-        best_path = None
-        best_distance = float("inf")
+        return tuple(nodes[i] for i in order), distance
 
-        # Calculate distances
-        print("Calculating shortest path...")
-        count = 0
-        search_limit = (
-            100000  # Since we don't need the perfect solution, limit the paths searched
+    # Prints the shortest round trip visiting every node in the region
+    def shortest_path_search(
+        self, top_left: tuple, bottom_right: tuple, weights=None, time_budget=1.0, reuse_distances=False
+    ):
+        best_path, best_distance = self.shortest_path(
+            top_left, bottom_right, weights, time_budget, reuse_distances=reuse_distances
         )
-        for path in permutations:
-            count += 1
-            if count == search_limit:
-                break
-            if count % 16789 == 0:
-                print(f"Paths searched: {count} ({int(count/search_limit*100)}%)")
-
-            path_distance = 0
-            prev_node = None
-
-            for node_id in path:
-                node_info = nodes_in_range[node_id]
-
-                if prev_node is not None:
-                    distance = self.path_distance(
-                        Vertex(node_info["x"], node_info["y"], ""),
-                        Vertex(
-                            nodes_in_range[prev_node]["x"],
-                            nodes_in_range[prev_node]["y"],
-                            "",
-                        ),
-                    )
-
-                    # If there is weights
-                    if weights:
-                        if self.is_river(node_id, prev_node):
-                            distance /= weights["water"]  # Scale by river weight
-                        else:
-                            distance /= weights["road"]  # Scale by road weight
-                    # distance = calculate_distance(node_info, nodes_in_range[prev_node])
-                    path_distance += distance
-
-                prev_node = node_id
-
-            # Add the distance from the last node back to the starting node
-            # Scale distance if weighted
-            scale_factor = 1
-            if weights:
-                if self.is_river(path[-1], path[0]):
-                    scale_factor = weights["water"]  # Scale by river weight
-                else:
-                    scale_factor = weights["road"]  # Scale by road weight
-            # Add distance
-            path_distance += (
-                self.path_distance(
-                    Vertex(node_info["x"], node_info["y"], ""),
-                    Vertex(
-                        nodes_in_range[path[0]]["x"], nodes_in_range[path[0]]["y"], ""
-                    ),
-                )
-                / scale_factor
-            )
-            # path_distance += calculate_distance(node_info, nodes_in_range[path[0]])
-
-            # Update the best path if this path is shorter
-            if path_distance < best_distance:
-                best_distance = path_distance
-                best_path = path
-        print(f"Paths searched: {count} ({int(count/search_limit*100)}%)", end="\n\n")
 
         print(f"Shortest path to visit all nodes within {top_left} to {bottom_right}:")
         shortest_path_list = [f"{node_id}" for node_id in best_path]
         print(tuple(shortest_path_list))
         print(f"Total distance of the shortest path: {best_distance}")
+        return best_path, best_distance
 
     # Shortest path, but with weights for diffrent types
-    def weighted_shortest_path_search(self, top_left: tuple, bottom_right: tuple):
+    def weighted_shortest_path_search(self, top_left: tuple, bottom_right: tuple, time_budget=1.0):
         weights = {"water": 32, "road": 60}
 
-        self.shortest_path_search(top_left, bottom_right, weights)
+        return self.shortest_path_search(top_left, bottom_right, weights, time_budget)
 
 # Finds cheapest insertion index into tour
-    def find_cheapest_insertion(self, to_insert, tour):
+    # matrix: DistanceMatrix over the tour's nodes, if there is one already
+    def find_cheapest_insertion(self, to_insert, tour, matrix: DistanceMatrix = None):
+        if matrix is None:
+            # Only three distances per place are needed, so work them out directly
+            def distance(node1, node2):
+                return self.path_distance(self.data(node1), self.data(node2))
+        else:
+            distance = matrix.distance
         cheapest = float('inf')
 
         for i in range(len(tour)):
             insert_cost = 0
             # Since we are replacing this connection, remove its lenght
-            insert_cost -= self.path_distance(self.data(tour[i]), self.data(tour[i-1]))
+            insert_cost -= distance(tour[i], tour[i-1])
             # Add the cost of new connection, from prevous to current, then cur to next
-            insert_cost += self.path_distance(self.data(tour[i-1]), self.data(to_insert))
-            insert_cost += self.path_distance(self.data(to_insert), self.data(tour[i]))
+            insert_cost += distance(tour[i-1], to_insert)
+            insert_cost += distance(to_insert, tour[i])
 
             # Save index if shorter found
             if insert_cost < cheapest:
@@ -533,152 +1106,153 @@ class Graph:
         return (cheapest, best_index)
 
     # Finds the shortest path to vist all in region (when gaph is complete)
-    def flight_path(self, top_left: tuple, bottom_right: tuple):
+    # moves/candidates: local search settings, see improve_tour
+    # reuse_distances: keep the region's DistanceMatrix for later queries
+    def flight_path(
+        self,
+        top_left: tuple,
+        bottom_right: tuple,
+        moves=("2opt", "oropt"),
+        candidates=8,
+        reuse_distances=False,
+    ):
         # Get region to search
-        to_vist = set()
-        for node in self.vertices_in_region(top_left, bottom_right):
-            to_vist.add(node)
-        
-        if len(to_vist) < 3:
-            raise ValueError("Graph must have at least 3 vertices")
-        
-        # Add any three points to tour and vist them
-        tour = [to_vist.pop() for loops in range(3)]
-
-        # Use "Cheapest insertion" algorithm to find reasonable tour
-        # (Find cost of adding all possible, and add the cheapest to tour) 
-        while to_vist:
-            best_lenght = float('inf')
-            for node in to_vist:
-
-                new_lenght, insert_index = self.find_cheapest_insertion(node, tour)
-        
-                # If a better insertion was found, save it
-                if new_lenght < best_lenght:
-                    best_lenght = new_lenght
-
-                    node_to_add = node
-                    index_to_insert = insert_index
-
-            tour.insert(index_to_insert, node_to_add) # Add best to current tour
-            to_vist.remove(node_to_add) # Since in tour, we have visited it
-
-        # Improve tour using 2-opt switching (switch all two edges)
-        # Keep swapping until no more improvement made
-        improved = True
-        while improved:
-            improved = False
-            for n in range(len(tour)-1):
-                for m in range(n+2, len(tour)):
-                    # Cost of paths that will be replaced
-                    improvement = self.path_distance(self.data(tour[n-1]), self.data(tour[n]))
-                    improvement += self.path_distance(self.data(tour[m-1]), self.data(tour[m]))
-                    # Cost of replacement
-                    improvement -= self.path_distance(self.data(tour[n-1]), self.data(tour[m-1]))
-                    improvement -= self.path_distance(self.data(tour[n]), self.data(tour[m]))
-
-                    if improvement > 0:
-                        improved = True
-                        # Swap the order of nodes n to m
-                        tour[n : m] = reversed(tour[n : m])
+        matrix = self.distance_matrix(
+            self.vertices_in_region(top_left, bottom_right), reuse_distances
+        )
 
         # Tour must start at "top right point of area"
-        # Find closest to "top right"
-        shortest_dis = float('inf')
-        for node in tour:
-            node_distance = self.path_distance(self.data(node), Vertex(bottom_right[0], top_left[1],""))
-
-            if node_distance < shortest_dis:
-                shortest_dis = node_distance
-                closest = node
-
-        # Shift list, until front is closest
-        while tour[0] != closest:
-            tour.insert(0, tour.pop(-1))
-
-        tour.append(tour[0])    # Tour must end at start
-
-        tour_lenght = 0
-        for i in range(len(tour)-1):
-            tour_lenght += self.path_distance(self.data(tour[i]), self.data(tour[i+1]))
+        return build_flight_path(matrix, (bottom_right[0], top_left[1]), moves, candidates)
+
+    # flight_path from several random starts, run in parallel (see multistart_flight_path)
+    # Returns (tour, tour_lenght, runs)
+    def flight_path_multistart(
+        self,
+        top_left: tuple,
+        bottom_right: tuple,
+        starts=8,
+        workers=None,
+        seed=0,
+        moves=("2opt", "oropt"),
+        candidates=8,
+    ):
+        nodes = self.vertices_in_region(top_left, bottom_right)
+        return multistart_flight_path(
+            nodes,
+            [self.data(node).x for node in nodes],
+            [self.data(node).y for node in nodes],
+            (bottom_right[0], top_left[1]),
+            starts,
+            workers,
+            seed,
+            moves,
+            candidates,
+        )
 
-        return tuple(tour), tour_lenght
+    # Returns an array-backed, read-only copy of the graph (see FrozenGraph)
+    def freeze(self):
+        return FrozenGraph(self)
     
-    # Return list of all cycles in graph
-    def list_cycles(self):
-        def dfs(node, visited, path):
-            visited[node] = True
-            path.append(node)
-
-            for neighbor_edge in LL_as_array(self.data(node))[1:]:
-                neighbor = neighbor_edge.node
-
-                # If the neighbor is not visited, continue DFS
-                if not visited[neighbor]:
-                    if dfs(neighbor, visited, path):
-                        return True
-                # Found a cycle
-                elif neighbor in path:
-                    # Cycle starts at repeated step
-                    cycle = path[path.index(neighbor):]
-                    cycle.append(neighbor)  # Cycle must end up at start
-                    cycles.append(tuple(cycle))
-
-            path.pop()
-            return False
+    # Yields every elementary cycle in graph once, as (start, ..., start)
+    # max_length: only cycles of at most this many edges (see iter_elementary_cycles)
+    def iter_cycles(self, max_length=None):
+        return iter_elementary_cycles(self.adjacency_list, self.neighbors, max_length)
 
-        visited = {node: False for node in self.adjacency_list}
-        cycles = []
-
-        for node in self.adjacency_list:
-            if not visited[node]:
-                dfs(node, visited, [])
-
-        return cycles
+    # Return list of all cycles in graph
+    def list_cycles(self, max_length=None):
+        return list(self.iter_cycles(max_length))
+
+    # Returns the strongly connected components (every node in one can reach
+    # every other), as lists of node ids
+    # Components are in topological order: edges only lead from a component
+    # to itself or a later one
+    # Edges towards nodes not added yet are left out
+    def strongly_connected_components(self):
+        return strongly_connected_components(self.adjacency_list, self.added_neighbors)[::-1]
+
+    # Returns the graph with each strongly connected component merged into one
+    # node, which has no cycles (see Condensation)
+    def condensation(self):
+        return Condensation(self.strongly_connected_components(), self.added_neighbors)
+
+    # Yields the node ids a node has edges towards, skipping nodes not added yet
+    def added_neighbors(self, node_id: int):
+        for edge in self.edges(node_id):
+            if edge.node in self.adjacency_list:
+                yield edge.node
+
+
+    # Changes the node(s) rivers are traced to by traverse_to_final_outlet
+    def set_outlets(self, outlets):
+        self.outlets = tuple(outlets)
+        self.clear_outlet_cache()
+
+    def clear_outlet_cache(self):
+        self.outlet_trees.clear()
+        self.outlet_paths.clear()
+        self.traversal_lists = None
+        self.traversal_positions = None
+        self.traversal_index = None
+
+    # Returns {node: next node on its shortest river path to an outlet}, with
+    # None for the outlets, found by one breadth-first-search up from the outlets
+    # Nodes that can't reach an outlet are left out
+    def outlet_tree(self, outlets=None):
+        outlets = self.outlets if outlets is None else tuple(outlets)
+        if outlets in self.outlet_trees:
+            return self.outlet_trees[outlets]
+
+        # Number of rivers between each node and its closest outlet
+        steps = {outlet: 0 for outlet in outlets if outlet in self.adjacency_list}
+        search_queue = deque(steps)
+        while search_queue:
+            search_node = search_queue.popleft()
+            for source, edge in self.upstream_river_edges(search_node):
+                if source not in steps:
+                    steps[source] = steps[search_node] + 1
+                    search_queue.append(source)
+
+        # Each node points at its first river that is one step closer,
+        # the same path a breadth-first-search down from the node would find
+        parent = {}
+        for node, node_steps in steps.items():
+            parent[node] = None
+            if node_steps == 0:
+                continue
+            for edge in self.river_edges(node):
+                if steps.get(edge.node) == node_steps - 1:
+                    parent[node] = edge.node
+                    break
 
+        self.outlet_trees[outlets] = parent
+        return parent
 
-    # Function that returns the traversed path from the input id to node 1
-    def traverse_to_final_outlet(self, source_node_id):
-        # Create an empty list to store the traversed nodes
-        traversed_nodes = []
+    # Function that returns the traversed path from the input id to the outlet
+    # (node 1, unless changed with set_outlets or outlets=)
+    def traverse_to_final_outlet(self, source_node_id, outlets=None):
+        outlets = self.outlets if outlets is None else tuple(outlets)
 
         # Check if the source node exists in the graph
         if source_node_id not in self.adjacency_list:
             print("Source node not found in the graph.")
-            return traversed_nodes
-
-        # Initialize a queue for BFS traversal
-        queue = [
-            (source_node_id, [source_node_id])
-        ]  # Each item in the queue is a tuple (node, path)
-
-        # Create a set to track visited nodes
-        visited = set()
-
-        # Perform BFS traversal
-        while queue:
-            current_node, path = queue.pop(0)
-            # print(f'Current node: {current_node} => Path: {path}')
-            visited.add(current_node)
-
-            # Check if node 1 is reached
-            if current_node == 1:
-                traversed_nodes = path
-                break
-
-            # Add unvisited neighboring nodes to the queue
-            for edge in LL_as_array(self.data(current_node))[1:]:
-                # Ignore non-rivers
-                if not (self.is_river(current_node, edge.node)):
-                    continue
-                # print(f'\n    Edge:{edge}')
-                neighbor_node = edge.node
-                if neighbor_node not in visited:
-                    new_path = path + [neighbor_node]
-                    queue.append((neighbor_node, new_path))
-
+            return []
+
+        if (outlets, source_node_id) not in self.outlet_paths:
+            parent = self.outlet_tree(outlets)
+            # Walk down the tree until reaching an outlet
+            path = []
+            node = source_node_id if source_node_id in parent else None
+            while node is not None:
+                path.append(node)
+                node = parent[node]
+            self.outlet_paths[(outlets, source_node_id)] = tuple(path)
+
+        traversed_nodes = list(self.outlet_paths[(outlets, source_node_id)])
         if not traversed_nodes:
-            print("Node 1 is not reachable from the source node.")
+            if len(outlets) == 1:
+                print(f"Node {outlets[0]} is not reachable from the source node.")
+            else:
+                print("No outlet is reachable from the source node.")
         return traversed_nodes
 
     def get_headwater_nodes_id(self):
@@ -700,6 +1274,46 @@ class Graph:
         # print(traversal_list)
         return traversal_list
 
+    # get_headwaters_traversal_list_to_final, kept until the graph changes
+    # The lists are shared between callers, so must not be modified
+    def headwater_traversals(self):
+        if self.traversal_lists is None:
+            self.traversal_lists = self.get_headwaters_traversal_list_to_final()
+        return self.traversal_lists
+
+    # Returns {headwater: {node: position in the headwater's traversal}}, so
+    # "is node on this path" and "how far along" are dictionary lookups
+    def headwater_traversal_positions(self):
+        if self.traversal_positions is None:
+            self.traversal_positions = {
+                headwater: {node: i for i, node in enumerate(traversal)}
+                for headwater, traversal in self.headwater_traversals().items()
+            }
+        return self.traversal_positions
+
+    # Returns ({node: [headwaters whose traversal reaches it]}, {headwater: order
+    # chemical_source checks it in}), kept until the graph changes
+    def headwater_traversal_index(self):
+        if self.traversal_index is None:
+            through = {}
+            order = {}
+            for i, (headwater, positions) in enumerate(self.headwater_traversal_positions().items()):
+                order[headwater] = i
+                for node in positions:
+                    through.setdefault(node, []).append(headwater)
+            self.traversal_index = (through, order)
+        return self.traversal_index
+
+    # Returns {headwater: number of the observed nodes on its traversal}
+    # (headwaters with none are left out, a node observed twice counts twice)
+    def observation_coverage(self, observed_nodes):
+        through = self.headwater_traversal_index()[0]
+        coverage = {}
+        for node in observed_nodes:
+            for headwater in through.get(node, ()):
+                coverage[headwater] = coverage.get(headwater, 0) + 1
+        return coverage
+
     def is_incremental_sequence(self, d):
         sorted_values = sorted(d.values())
         return all(
@@ -719,6 +1333,9 @@ class Graph:
         return sorted_observation
     
     def find_common_and_difference(self,list1, list2):
+        # Set (or dict) membership is O(1), unlike a list
+        if not isinstance(list2, (set, dict)):
+            list2 = set(list2)
         common_elements = [item for item in list1 if item in list2]
         difference_elements = [item for item in list1 if item not in list2]
 
@@ -726,14 +1343,25 @@ class Graph:
 
     # checks if the `current_node` is source of contamination or not
     def all_contamination_nodes_in_traversal(
-        self, current_node, observed_nodes, headwater_node_traversals, input_sequence
+        self,
+        current_node,
+        observed_nodes,
+        headwater_node_traversals,
+        input_sequence,
+        headwater_node_positions=None,
     ):
         contaminated_node = None
+        # position of each node in the traversal (see headwater_traversal_positions)
+        if headwater_node_positions is None:
+            positions = {
+                node: i for i, node in enumerate(headwater_node_traversals[current_node])
+            }
+        else:
+            positions = headwater_node_positions[current_node]
         # save index of each node in a vairalbe
         node_index_dict = {}
         for item in observed_nodes:
-            index = headwater_node_traversals[current_node].index(item)
-            node_index_dict[item] = index
+            node_index_dict[item] = positions[item]
         # rearrange the observed nodes in traversed order
         # sort the nodes_index in ascending order of there values, i.e. index
         node_index_dict = {
@@ -768,8 +1396,9 @@ class Graph:
     # returns all directly connected headwater sources
     def check_direct_connection_to_headwater(self, node_id, traversal_dict):
         connected_to_list = []
-        for node in traversal_dict:
-            if traversal_dict[node][1] == node_id:
+        # Only nodes with an edge to node_id can reach it in one step
+        for node in dict.fromkeys(self.predecessors(node_id)):
+            if node in traversal_dict and traversal_dict[node][1:2] == [node_id]:
                 connected_to_list.append(node)
         return connected_to_list
     
@@ -788,22 +1417,11 @@ class Graph:
         
         bottom_right_x = 650 if bottom_right[0] > 650 else bottom_right[0]
         bottom_right_y = 650 if bottom_right[1] > 650 else bottom_right[1]
-            
 
-        in_region = []  # All nodes found within region
-        for node in self.adjacency_list:
-            node_data = self.data(node)
-            if node_data.type == source_type:
-                if (
-                    node_data.x >= top_left_x
-                    and node_data.x <= bottom_right_x
-                ) and (
-                    node_data.y >= top_left_y
-                    and node_data.y <= bottom_right_y
-                ):
-                    in_region.append(node)
 
-        return in_region
+        return self.spatial_index.in_region(
+            (top_left_x, top_left_y), (bottom_right_x, bottom_right_y), types=(source_type,)
+        )
     
     def get_sum_of_square(self, data):
         # Compute the sum of all values
@@ -820,30 +1438,44 @@ class Graph:
 
         return sum_of_squares
 
-    def chemical_source(self, input_sequence):
+    # One step of chemical_source for a single observation subset
+    # Returns (possible_headwaters, possible_source_pool), where the pool holds
+    # node ids and frozensets of observed nodes (sub-problems still to be solved)
+    # coverage: observation_coverage of the input, if already known
+    def contamination_subproblem(
+        self, input_sequence, headwater_node_traversals, headwater_node_positions, coverage=None
+    ):
         possible_headwaters = []
 
         # Extracting all node ids from sequence for easy lookup
         observed_nodes = []
-        concentration_dict = {}
         possible_source_pool = []
-        
+
         # extract the given observation for ease use
         for node, conc in input_sequence:
             observed_nodes.append(node)
-            concentration_dict[node] = conc
 
             # if the node is a `headwater` itself, add as possible contamination source
             if self.data(node).type == source_type:
                 possible_headwaters.append(node)
 
-        # get headwater source of the junction
-        headwater_node_traversals = self.get_headwaters_traversal_list_to_final()
+        # A headwater with fewer than two of the observed nodes on its path (or
+        # none, for a single observation) adds nothing below, so only those with
+        # enough are checked, in the usual order
+        headwaters = headwater_node_traversals
+        if observed_nodes:
+            if coverage is None:
+                coverage = self.observation_coverage(observed_nodes)
+            least = min(2, len(observed_nodes))
+            headwaters = sorted(
+                (headwater for headwater, count in coverage.items() if count >= least),
+                key=self.headwater_traversal_index()[1].get,
+            )
 
-        for node in headwater_node_traversals:
+        for node in headwaters:
             # check if ALL the observed conentration are in the flow of water to the final outlet.
             all_observed_in_path = all(
-                item in headwater_node_traversals[node] for item in observed_nodes
+                item in headwater_node_positions[node] for item in observed_nodes
             )
             # if all the nodes are present in the traversal
             if all_observed_in_path is True:
@@ -853,6 +1485,7 @@ class Graph:
                     observed_nodes=observed_nodes,
                     headwater_node_traversals=headwater_node_traversals,
                     input_sequence=input_sequence,
+                    headwater_node_positions=headwater_node_positions,
                 )
                 
                 if result is not None:
@@ -863,7 +1496,7 @@ class Graph:
             else:
                 
                 # separate the input_sequence into those in the sequence and individual node
-                common_nodes_list, difference_nodes_list = self.find_common_and_difference(observed_nodes, headwater_node_traversals[node])
+                common_nodes_list, difference_nodes_list = self.find_common_and_difference(observed_nodes, headwater_node_positions[node])
                 
                 # if there is no common nodes between the two list, then skip
                 common_nodes_list_len = len(common_nodes_list)
@@ -872,8 +1505,7 @@ class Graph:
                 
                 node_index_dict = {}
                 for item in common_nodes_list:
-                    index = headwater_node_traversals[node].index(item)
-                    node_index_dict[item] = index
+                    node_index_dict[item] = headwater_node_positions[node][item]
                 # rearrange the observed nodes in traversed order
                 # sort the nodes_index in ascending order of there values, i.e. index
                 node_index_dict = {
@@ -887,12 +1519,9 @@ class Graph:
                         possible_source_pool.extend(direct_source_list)
                 
 
-                # if there is group of node in a traversal path
-                # get sub-list of the tuple with concentration data that are present in the common_nodes_list
-                common_input_sequence = self.get_formatted_input_sequence(list=common_nodes_list, input_sequence=input_sequence)
-
-                # get the likely nodes using recursion and append to possible_source_pool list
-                possible_source_pool.extend(self.chemical_source(common_input_sequence))
+                # if there is group of node in a traversal path, the likely
+                # nodes of the group are solved as a sub-problem
+                possible_source_pool.append(frozenset(common_nodes_list))
                 # print(f'Possible source pool for {node}: {possible_source_pool}')
 
                 # if there is one node not in the traversed path
@@ -930,37 +1559,518 @@ class Graph:
                             vertex_data = self.data(vertex_id)
                             temp_distance[vertex_id] = self.path_distance(differnce_node_data, vertex_data)
                         # add the node is with the least distance to the `differnce_node_id` to the possible_source_pool
-                        possible_source_pool.append(min(temp_distance, key=temp_distance.get))
+                        # (if there is no headwater in the region, there is no seepage source)
+                        if temp_distance:
+                            possible_source_pool.append(min(temp_distance, key=temp_distance.get))
                         
-                # if there are more nodes in the difference_nodes_list, use recursion to get possible nodes and append to possible_source_pool list
-                # get sub-list of the tuple with concentration data that are present in the difference_nodes_list
-                difference_input_sequence = self.get_formatted_input_sequence(list=difference_nodes_list, input_sequence=input_sequence)
-                possible_source_pool.extend(self.chemical_source(difference_input_sequence))
+                # if there are more nodes in the difference_nodes_list, solve them as a sub-problem too
+                possible_source_pool.append(frozenset(difference_nodes_list))
                     
-        # if the `possible_source_pool` is not empty
-        if len(possible_source_pool) != 0:
-            # remove duplicates from possible_source_pool
-            possible_source_pool = list(dict.fromkeys(possible_source_pool))
-            # variable to store the sum of squared distance
-            sum_of_squared = {}
-            # calculate sum of squared of the distance of each observed node with possible nodes
-            # iterating over the `possible_node`
-            for possible_node in possible_source_pool:
-                # temporary variable to store distance between 
-                temp_distance = {}
-                for observed_node in observed_nodes:
-                    temp_distance_value = self.path_distance(self.data(possible_node), self.data(observed_node))
-                    temp_distance[observed_node] = temp_distance_value
-                sum_of_squared[possible_node] = self.get_sum_of_square(temp_distance)
-            # add the node_id with the least sum of squared to the `possible_headwaters`
-            possible_headwaters.append(min(sum_of_squared, key=sum_of_squared.get))
-            print(f'possible node value: {possible_source_pool}')
-
-        # remove repeated values
-        possible_headwaters = list(dict.fromkeys(possible_headwaters))
+        return possible_headwaters, possible_source_pool
+
+    # Ranks candidate sources by the sum of squared deviations of their
+    # distances to the observed nodes (lowest first, ties keep the given order)
+    # Returns [(node_id, sum_of_squares), ...]
+    def rank_source_candidates(self, candidates, observed_nodes):
+        candidates = list(dict.fromkeys(candidates))
+        observed_nodes = list(dict.fromkeys(observed_nodes))
+        observed_x = array("d", [self.data(node).x for node in observed_nodes])
+        observed_y = array("d", [self.data(node).y for node in observed_nodes])
+
+        # candidate x observation distance matrix, one row per candidate
+        rows = []
+        for node in candidates:
+            candidate = self.data(node)
+            rows.append(
+                array(
+                    "d",
+                    [
+                        point_distance(candidate.x, candidate.y, x, y)
+                        for x, y in zip(observed_x, observed_y)
+                    ],
+                )
+            )
+        scores = row_sum_of_squares(rows)
+
+        order = sorted(range(len(candidates)), key=scores.__getitem__)
+        return [(candidates[i], scores[i]) for i in order]
+
+    # Solves chemical_source for the given observations
+    # Returns (possible headwaters, ranked pool), where the ranked pool is
+    # rank_source_candidates of the candidates that didn't match a path directly
+    # Groups of observations that don't share one path are solved as smaller
+    # sub-problems. Each observation subset is solved once (memoised on the
+    # frozenset of its nodes), bottom-up with an explicit stack, so there is no
+    # recursion limit and the traversals are only computed once per query
+    # verbose: print each candidate pool
+    # solved: {subset: result} to reuse between calls, when the observations of
+    # a subset haven't changed (see ContaminationStream)
+    # coverage: observation_coverage of input_sequence, if already known
+    def solve_chemical_source(self, input_sequence, verbose=True, solved=None, coverage=None):
+        input_sequence = list(input_sequence)
+
+        # get headwater source of the junction
+        headwater_node_traversals = self.headwater_traversals()
+        headwater_node_positions = self.headwater_traversal_positions()
+
+        root = frozenset(node for node, conc in input_sequence)
+        plans = {}  # subset -> (possible_headwaters, possible_source_pool)
+        if solved is None:
+            solved = {}  # subset -> (possible headwaters, ranked pool)
+        stack = [root]
+        while stack:
+            subset = stack[-1]
+            if subset in solved:
+                stack.pop()
+                continue
+
+            if subset not in plans:
+                # The sub-problem's observations, in the order they were given
+                plans[subset] = self.contamination_subproblem(
+                    [tup for tup in input_sequence if tup[0] in subset],
+                    headwater_node_traversals,
+                    headwater_node_positions,
+                    coverage if subset == root else None,
+                )
+            possible_headwaters, possible_source_pool = plans[subset]
+
+            # Solve the sub-problems this one depends on first
+            pending = [
+                item for item in possible_source_pool
+                if isinstance(item, frozenset) and item not in solved
+            ]
+            if pending:
+                stack.extend(reversed(pending))
+                continue
+            stack.pop()
+
+            # Replace each sub-problem with its result
+            pool = []
+            for item in possible_source_pool:
+                if isinstance(item, frozenset):
+                    pool.extend(solved[item][0])
+                else:
+                    pool.append(item)
+
+            # if the `possible_source_pool` is not empty
+            ranked = []
+            if len(pool) != 0:
+                # remove duplicates from possible_source_pool
+                pool = list(dict.fromkeys(pool))
+                observed_nodes = [node for node, conc in input_sequence if node in subset]
+                ranked = self.rank_source_candidates(pool, observed_nodes)
+                # add the node_id with the least sum of squared to the `possible_headwaters`
+                possible_headwaters = possible_headwaters + [ranked[0][0]]
+                if verbose:
+                    print(f'possible node value: {pool}')
+
+            # remove repeated values
+            solved[subset] = (list(dict.fromkeys(possible_headwaters)), ranked)
+            del plans[subset]
+
+        possible_headwaters, ranked_pool = solved[root]
+        return list(possible_headwaters), list(ranked_pool)
+
+    # Returns the likely headwater source(s) of the observed contamination
+    # input_sequence: [(node_id, concentration), ...]
+    def chemical_source(self, input_sequence, verbose=True):
+        possible_headwaters, ranked_pool = self.solve_chemical_source(input_sequence, verbose)
         # return the nodes
         return possible_headwaters
 
+    # Returns every candidate source chemical_source picked from, ranked by
+    # sum of squared distances: [(node_id, sum_of_squares), ...]
+    # (chemical_source keeps only the first of these)
+    def chemical_source_candidates(self, input_sequence, verbose=True):
+        possible_headwaters, ranked_pool = self.solve_chemical_source(input_sequence, verbose)
+        return ranked_pool
+
+    # Runs chemical_source on every observation set
+    # The headwater traversals are built once, then each worker process is sent
+    # the graph (with them) once and answers a share of the queries
+    # workers: None for one per CPU, 1 for no extra processes
+    # mp_context: multiprocessing context for the workers, None for the default
+    # Returns [{"sources", "seconds"}, ...] in the order of observation_sets
+    def chemical_source_batch(self, observation_sets, workers=None, mp_context=None):
+        observation_sets = [list(sequence) for sequence in observation_sets]
+        self.headwater_traversal_index()
+
+        if workers == 1:
+            init_contamination_worker(self)
+            results = [run_contamination_worker(sequence) for sequence in observation_sets]
+        else:
+            # Send the queries in chunks, a few per worker
+            chunksize = max(len(observation_sets) // ((workers or os.cpu_count() or 1) * 4), 1)
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=mp_context,
+                initializer=init_contamination_worker,
+                initargs=(self,),
+            ) as pool:
+                results = list(
+                    pool.map(run_contamination_worker, observation_sets, chunksize=chunksize)
+                )
+
+        return [{"sources": sources, "seconds": seconds} for sources, seconds in results]
+
+
+# Live front end to chemical_source over a sliding time window of readings
+# Readings are (node_id, concentration, timestamp), in timestamp order. Each
+# sensor keeps its latest reading until that is `window` seconds older than
+# the newest reading.
+# The solver's sub-problem results (one per subset of sensors) are kept between
+# readings. A reading only changes the subsets holding its sensor (and those of
+# any sensors that left the window), so only those are solved again, the rest
+# are reused. For the subsets that are solved, only headwaters with enough
+# sensors on their traversal are checked, using the coverage counts kept here.
+# The graph's headwater traversals are re-read if they changed.
+class ContaminationStream:
+    def __init__(self, graph: Graph, window=60):
+        if window <= 0:
+            raise ValueError("Window must be positive")
+        self.graph = graph
+        self.window = window
+        self.readings = deque()  # (timestamp, node_id, concentration), oldest first
+        self.latest = {}  # node_id -> (timestamp, concentration), latest reading first in
+        self.coverage = {}  # headwater -> number of sensors in window on its traversal
+        self.solved = {}  # Sub-problem results, see Graph.solve_chemical_source
+        self.positions = None  # Graph's headwater_traversal_positions
+        self.through = {}  # node_id -> [headwater, ...] whose traversal reaches it
+        self.rebuild()
+
+    def __len__(self):
+        return len(self.latest)
+
+    # Rebuilds the coverage from the graph, and forgets every result
+    def rebuild(self):
+        self.positions = self.graph.headwater_traversal_positions()
+        self.through = self.graph.headwater_traversal_index()[0]
+        self.coverage = self.graph.observation_coverage(self.latest)
+        self.solved = {}
+
+    # Adds `step` to the coverage of every headwater reaching node
+    def change_coverage(self, node_id, step):
+        for headwater in self.through.get(node_id, ()):
+            count = self.coverage.get(headwater, 0) + step
+            if count:
+                self.coverage[headwater] = count
+            else:
+                del self.coverage[headwater]
+
+    # Forgets the results of every subset holding the node
+    def forget(self, node_id):
+        self.solved = {subset: result for subset, result in self.solved.items() if node_id not in subset}
+
+    # Adds one reading, dropping any that have left the window
+    def add(self, node_id, concentration, timestamp):
+        if node_id not in self.graph.adjacency_list:
+            raise KeyError(f"\nNode '{node_id}' isn't in the graph")
+        if self.readings and timestamp < self.readings[-1][0]:
+            raise ValueError("Readings must arrive in timestamp order")
+
+        if node_id in self.latest:
+            # Keep sensors in the order of their latest reading
+            del self.latest[node_id]
+        else:
+            self.change_coverage(node_id, 1)
+        self.latest[node_id] = (timestamp, concentration)
+        self.readings.append((timestamp, node_id, concentration))
+        self.forget(node_id)
+
+        # Expire readings, a sensor leaves once its latest reading has
+        while self.readings and self.readings[0][0] <= timestamp - self.window:
+            old_timestamp, old_node, old_concentration = self.readings.popleft()
+            if self.latest.get(old_node) == (old_timestamp, old_concentration):
+                del self.latest[old_node]
+                self.change_coverage(old_node, -1)
+                self.forget(old_node)
+
+    # Current observations, as chemical_source's input_sequence
+    def observations(self):
+        return [(node, concentration) for node, (timestamp, concentration) in self.latest.items()]
+
+    # Solves the window, reusing results of unchanged subsets
+    # Returns (possible headwaters, ranked pool), see Graph.solve_chemical_source
+    def solve(self):
+        if self.graph.headwater_traversal_positions() is not self.positions:
+            self.rebuild()
+        sequence = self.observations()
+        if not sequence:
+            return [], []
+        return self.graph.solve_chemical_source(
+            sequence, verbose=False, solved=self.solved, coverage=self.coverage
+        )
+
+    # Likely sources of the readings in the window (same as chemical_source)
+    def sources(self):
+        return self.solve()[0]
+
+    # Ranked candidates of the window (same as chemical_source_candidates)
+    def candidates(self):
+        return self.solve()[1]
+
+    # Feeds an iterable of (node_id, concentration, timestamp) readings
+    # Yields (timestamp, sources) after each reading
+    def consume(self, readings):
+        for node_id, concentration, timestamp in readings:
+            self.add(node_id, concentration, timestamp)
+            yield timestamp, self.sources()
+
+    # consume for an async iterator of readings
+    async def aconsume(self, readings):
+        async for node_id, concentration, timestamp in readings:
+            self.add(node_id, concentration, timestamp)
+            yield timestamp, self.sources()
+
+
+# Read-only graph stored in compressed sparse row (CSR) form
+# Nodes are given dense indexes 0..n-1, and the edges of node i are
+# targets[offsets[i] : offsets[i + 1]] (same order as the LinkedList)
+class FrozenGraph:
+    def __init__(self, graph: Graph = None):
+        self.node_ids = []  # Dense index -> node id
+        self.index = {}  # Node id -> dense index
+        self.type_names = []  # Type code -> type name
+        self.type_codes = {}  # Type name -> type code
+
+        # Per node buffers
+        self.x = array("d")
+        self.y = array("d")
+        self.type = array("B")  # Type code of each node
+
+        # Per edge buffers, NaN where not populated yet
+        self.offsets = array("l", [0])
+        self.targets = array("l")
+        self.weights = array("d")
+        self.flow_rates = array("d")
+        self.river = array("B")  # 1 if the edge represents a river
+
+        self.source_flow = 1  # Flow of a headwater, unless set in source_flows
+        self.source_flows = {}  # Node id -> flow starting at that node
+
+        if graph is None:
+            return
+
+        self.source_flow = graph.source_flow
+        self.source_flows = dict(graph.source_flows)
+
+        for node_id, vertex in graph.adjacency_list.items():
+            self.append_node(node_id, vertex.x, vertex.y, vertex.type)
+        edge_sources = []
+        for node_id in graph.adjacency_list:
+            for edge in graph.edges(node_id):
+                edge_sources.append((node_id, edge.node, edge.weight, edge.flow_rate))
+        self.link_edges(edge_sources)
+
+    # Number of nodes
+    def __len__(self):
+        return len(self.node_ids)
+
+    def append_node(self, node_id: int, x, y, type: str):
+        if node_id in self.index:
+            raise ValueError("Node '" + str(node_id) + "' is already in graph")
+
+        if type not in self.type_codes:
+            self.type_codes[type] = len(self.type_names)
+            self.type_names.append(type)
+
+        self.index[node_id] = len(self.node_ids)
+        self.node_ids.append(node_id)
+        self.x.append(x)
+        self.y.append(y)
+        self.type.append(self.type_codes[type])
+
+    # Builds the CSR edge buffers from (source, destination, weight, flow_rate)
+    # Can only be called once, after every node has been appended
+    def link_edges(self, edge_list: list):
+        if self.targets:
+            raise ValueError("Edges have already been linked")
+
+        nan = float("nan")
+        # Count edges of each node, then turn counts into offsets
+        counts = array("l", bytes(array("l").itemsize * len(self.node_ids)))
+        for source, destination, weight, flow_rate in edge_list:
+            if destination not in self.index:
+                raise KeyError("\nNode '" + str(destination) + "' isn't in the graph")
+            counts[self.index[source]] += 1
+        for count in counts:
+            self.offsets.append(self.offsets[-1] + count)
+
+        # Place every edge in its slot, keeping the original order per node
+        total = self.offsets[-1]
+        self.targets = array("l", bytes(array("l").itemsize * total))
+        self.weights = array("d", [nan]) * total
+        self.flow_rates = array("d", [nan]) * total
+        self.river = array("B", bytes(total))
+        next_slot = array("l", self.offsets[:-1])
+        for source, destination, weight, flow_rate in edge_list:
+            i = self.index[source]
+            j = self.index[destination]
+            slot = next_slot[i]
+            next_slot[i] += 1
+
+            self.targets[slot] = j
+            if weight is not None:
+                self.weights[slot] = weight
+            if flow_rate is not None:
+                self.flow_rates[slot] = flow_rate
+            self.river[slot] = is_river_connection(
+                source, destination, self.type_name(i), self.type_name(j)
+            )
+
+    def type_name(self, i: int):
+        return self.type_names[self.type[i]]
+
+    # Yields (edge slot, target index) of each edge of dense node i
+    def edge_slots(self, i: int):
+        for slot in range(self.offsets[i], self.offsets[i + 1]):
+            yield slot, self.targets[slot]
+
+    # Yields the node ids a node has edges towards
+    def neighbors(self, node_id: int):
+        for slot, j in self.edge_slots(self.index[node_id]):
+            yield self.node_ids[j]
+
+    # Returns all vertices within a given region
+    # top_left/bottom_right: (x, y)
+    def vertices_in_region(self, top_left: tuple, bottom_right: tuple):
+        if len(top_left) != 2 or len(bottom_right) != 2:
+            raise ValueError("Region courner(s) must have two arguments (x, y)")
+
+        in_region = []
+        for i in range(len(self.node_ids)):
+            if (
+                top_left[0] <= self.x[i] <= bottom_right[0]
+                and top_left[1] <= self.y[i] <= bottom_right[1]
+            ):
+                in_region.append(self.node_ids[i])
+        return in_region
+
+    # Sets the flow rate of every river edge (same rules as Graph.populate_flow_rate)
+    def populate_flow_rate(self, source_flow=1):
+        self.source_flow = source_flow
+        source_code = self.type_codes.get(source_type)
+        river_codes = {self.type_codes[type] for type in river_types if type in self.type_codes}
+        n = len(self.node_ids)
+
+        # Count incoming rivers of every node
+        incoming_rivers = array("l", bytes(array("l").itemsize * n))
+        for slot in range(len(self.targets)):
+            if self.river[slot]:
+                incoming_rivers[self.targets[slot]] += 1
+
+        # Flow starts at sources (and nodes given a flow in source_flows), and
+        # every river node nothing flows into can be searched first
+        incoming_flow = array("d", bytes(array("d").itemsize * n))
+        search_queue = deque()
+        for i in range(n):
+            if self.type[i] not in river_codes:
+                continue
+            node_id = self.node_ids[i]
+            if node_id in self.source_flows:
+                incoming_flow[i] = self.source_flows[node_id]
+            elif self.type[i] == source_code:
+                incoming_flow[i] = source_flow
+            if incoming_rivers[i] == 0:
+                search_queue.append(i)
+
+        # Only search a node once all of its incoming rivers are set
+        while search_queue:
+            i = search_queue.popleft()
+            for slot, j in self.edge_slots(i):
+                if not self.river[slot]:
+                    continue
+                self.flow_rates[slot] = incoming_flow[i]
+                incoming_flow[j] += incoming_flow[i]
+                incoming_rivers[j] -= 1
+                if incoming_rivers[j] == 0:
+                    search_queue.append(j)
+
+    # Returns the path of node ids, following rivers, from the source to the outlet
+    def traverse_to_final_outlet(self, source_node_id, outlet=1):
+        if source_node_id not in self.index:
+            print("Source node not found in the graph.")
+            return []
+        if outlet not in self.index:
+            print(f"Outlet node {outlet} not found in the graph.")
+            return []
+
+        # Breadth-first-search, remembering where each node was reached from
+        start = self.index[source_node_id]
+        end = self.index[outlet]
+        parent = {start: None}
+        search_queue = deque([start])
+        while search_queue:
+            i = search_queue.popleft()
+            if i == end:
+                break
+            for slot, j in self.edge_slots(i):
+                if self.river[slot] and j not in parent:
+                    parent[j] = i
+                    search_queue.append(j)
+
+        if end not in parent:
+            print(f"Node {outlet} is not reachable from the source node.")
+            return []
+
+        # Walk back from the outlet to build the path
+        path = []
+        i = end
+        while i is not None:
+            path.append(self.node_ids[i])
+            i = parent[i]
+        return path[::-1]
+
+    # Yields every elementary cycle in graph once (same order as Graph.iter_cycles)
+    def iter_cycles(self, max_length=None):
+        for cycle in iter_elementary_cycles(
+            range(len(self.node_ids)),
+            lambda i: (j for slot, j in self.edge_slots(i)),
+            max_length,
+        ):
+            yield tuple(self.node_ids[i] for i in cycle)
+
+    # Return list of all cycles in graph
+    def list_cycles(self, max_length=None):
+        return list(self.iter_cycles(max_length))
+
+    # Finds the shortest path to vist all in region
+    def flight_path(
+        self, top_left: tuple, bottom_right: tuple, moves=("2opt", "oropt"), candidates=8
+    ):
+        nodes = self.vertices_in_region(top_left, bottom_right)
+        matrix = DistanceMatrix(
+            nodes,
+            [self.x[self.index[node]] for node in nodes],
+            [self.y[self.index[node]] for node in nodes],
+        )
+
+        return build_flight_path(matrix, (bottom_right[0], top_left[1]), moves, candidates)
+
+    # flight_path from several random starts, run in parallel (see multistart_flight_path)
+    def flight_path_multistart(
+        self,
+        top_left: tuple,
+        bottom_right: tuple,
+        starts=8,
+        workers=None,
+        seed=0,
+        moves=("2opt", "oropt"),
+        candidates=8,
+    ):
+        nodes = self.vertices_in_region(top_left, bottom_right)
+        return multistart_flight_path(
+            nodes,
+            [self.x[self.index[node]] for node in nodes],
+            [self.y[self.index[node]] for node in nodes],
+            (bottom_right[0], top_left[1]),
+            starts,
+            workers,
+            seed,
+            moves,
+            candidates,
+        )
+
 
 # Add the CSV data into the graph
 def parse_csv_into_adjacency_list(graph: Graph):
@@ -990,6 +2100,696 @@ def parse_csv_into_adjacency_list(graph: Graph):
                 graph.add_edge(node_id, Edge(linked))
 
 
+# Read the CSV data straight into a FrozenGraph, without building a Graph first
+def parse_csv_into_frozen_graph(file_name=CSV_FILE):
+    frozen = FrozenGraph()
+    edge_list = []
+    with open(file_name, mode="r", newline="") as file:
+        reader = csv.DictReader(file)
+        for row in reader:
+            node_id = int(row["Node"])
+            linked = int(row["linked"])
+
+            # Node rows can be repeated, only the first is kept
+            if node_id not in frozen.index:
+                frozen.append_node(node_id, int(row["x"]), int(row["y"]), row["type"])
+            # Node 0 means no next adjacent node
+            if linked != 0:
+                edge_list.append((node_id, linked, None, None))
+
+    frozen.link_edges(edge_list)
+    return frozen
+
+
+# Works out if an edge between two nodes represents a river
+def is_river_connection(source: int, destination: int, source_kind: str, destination_kind: str):
+    if not is_river_kind(source_kind, destination_kind):
+        return False
+
+    # Skip blacklisted paths
+    if (source, destination) in non_river_blacklist:
+        return False
+
+    # If it didn't fail the prevous test, it must be a river
+    return True
+
+
+# Whether an edge between these node types can be a river (ignoring the blacklist)
+def is_river_kind(source_kind: str, destination_kind: str):
+    # Both nodes must be river types
+    if (destination_kind not in river_types) or (source_kind not in river_types):
+        return False
+    # Rivers can't flow towards a source
+    if destination_kind == source_type:
+        return False
+    return True
+
+
+# Exact shortest round trip over a cost matrix, using Held-Karp dynamic programming
+# cost[i][j]: cost of travelling from i to j (doesn't need to be symmetric)
+# Returns (order, total cost), where order starts at 0 and doesn't repeat it at the end
+# Takes O(2^n * n^2) time, so is only suitable for small n
+def held_karp_tour(cost: list):
+    n = len(cost)
+    if n <= 1:
+        return list(range(n)), 0
+    if n == 2:
+        return [0, 1], cost[0][1] + cost[1][0]
+
+    # Subsets are bitmasks over nodes 1..n-1 (node 0 is the start)
+    # best[mask][j]: cheapest path from 0 visiting mask, ending at j (j in mask)
+    size = 1 << (n - 1)
+    inf = float("inf")
+    best = [[inf] * n for mask in range(size)]
+    parent = [[0] * n for mask in range(size)]
+    for j in range(1, n):
+        best[1 << (j - 1)][j] = cost[0][j]
+
+    for mask in range(1, size):
+        row = best[mask]
+        for j in range(1, n):
+            if not mask >> (j - 1) & 1 or row[j] == inf:
+                continue
+            # Extend the path ending at j to every unvisited k
+            path_cost = row[j]
+            cost_j = cost[j]
+            for k in range(1, n):
+                if mask >> (k - 1) & 1:
+                    continue
+                next_mask = mask | 1 << (k - 1)
+                new_cost = path_cost + cost_j[k]
+                if new_cost < best[next_mask][k]:
+                    best[next_mask][k] = new_cost
+                    parent[next_mask][k] = j
+
+    # Close the tour back to 0
+    full = size - 1
+    total, last = min((best[full][j] + cost[j][0], j) for j in range(1, n))
+
+    # Walk back through parents to recover the order
+    order = []
+    mask = full
+    while last:
+        order.append(last)
+        mask, last = mask & ~(1 << (last - 1)), parent[mask][last]
+    order.append(0)
+    return order[::-1], total
+
+
+# Cost of a round trip over a cost matrix
+def tour_cost(order: list, cost: list):
+    return sum(cost[order[i - 1]][order[i]] for i in range(len(order)))
+
+
+# Short round trip over a cost matrix, for when there are too many nodes for Held-Karp
+# Builds a tour by cheapest insertion, then improves it with 2-opt and node relocation
+# until no improvement is found or time_budget seconds have passed
+# (the budget covers building the tour too, see cheapest_insertion_tour)
+# Symmetric costs use improve_tour, others the direction-aware search below
+# Returns (order, total cost), where order starts at 0 and doesn't repeat it at the end
+def heuristic_tour(cost: list, time_budget=1.0):
+    n = len(cost)
+    if n <= 3:
+        return list(range(n)), tour_cost(list(range(n)), cost)
+    deadline = time.perf_counter() + time_budget
+
+    # Cheapest insertion, starting with the first three nodes
+    order = cheapest_insertion_tour([0, 1, 2], range(3, n), cost, deadline)
+
+    # Reversing part of the tour only changes its cost if costs depend on direction
+    # (each row compared with the matching column of the transposed matrix)
+    symmetric = all(tuple(row) == column for row, column in zip(cost, zip(*cost)))
+    if symmetric:
+        if time.perf_counter() < deadline:
+            order = improve_tour(order, cost, deadline=deadline)
+        # Start the order at 0 again
+        front = order.index(0)
+        order = order[front:] + order[:front]
+        return order, tour_cost(order, cost)
+
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+
+        # 2-opt: reverse order[i:j], costs inside the segment change direction
+        for i in range(1, n - 1):
+            for j in range(i + 2, n + 1):
+                before, after = order[i - 1], order[j % n]
+                change = cost[before][order[j - 1]] + cost[order[i]][after]
+                change -= cost[before][order[i]] + cost[order[j - 1]][after]
+                for k in range(i, j - 1):
+                    change += cost[order[k + 1]][order[k]] - cost[order[k]][order[k + 1]]
+                if change < -1e-12:
+                    order[i:j] = order[i:j][::-1]
+                    improved = True
+                if time.perf_counter() > deadline:
+                    break
+            if time.perf_counter() > deadline:
+                break
+
+        # Relocation: move a single node to a cheaper place in the tour
+        for i in range(1, n):
+            node = order[i]
+            before, after = order[i - 1], order[(i + 1) % n]
+            removed = cost[before][node] + cost[node][after] - cost[before][after]
+            rest = order[:i] + order[i + 1 :]
+            best = (0, None)
+            for k in range(1, len(rest) + 1):
+                added = cost[rest[k - 1]][node] + cost[node][rest[k % len(rest)]]
+                added -= cost[rest[k - 1]][rest[k % len(rest)]]
+                if added - removed < best[0] - 1e-12:
+                    best = (added - removed, k)
+            if best[1] is not None:
+                rest.insert(best[1], node)
+                order = rest
+                improved = True
+            if time.perf_counter() > deadline:
+                break
+
+    return order, tour_cost(order, cost)
+
+
+# Using Pythagoras Theorem to approximate lenght of path between two points
+def point_distance(x1, y1, x2, y2):
+    return math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
+
+
+# Sum of squared deviations from the mean of each row (see get_sum_of_square)
+def row_sum_of_squares(rows):
+    scores = array("d")
+    for row in rows:
+        average = sum(row) / len(row)
+        scores.append(sum((value - average) ** 2 for value in row))
+    return scores
+
+
+# Extends a tour with every node in `remaining`, by always adding the node that
+# increases the tour lenght the least ("Cheapest insertion")
+# Each node keeps its cheapest place in the tour, and only the places next to
+# the last insertion are checked again, with a heap to find the overall cheapest
+# (a node that loses its place keeps its old cost as a lower bound, and is only
+# searched in full if that bound reaches the top of the heap)
+# tour/remaining: positions in the distance matrix
+# deadline: time.perf_counter() value after which the nodes left are put at
+# the last place found for them, rather than searched for
+def cheapest_insertion_tour(tour: list, remaining, distance, deadline=None):
+    if not tour:
+        raise ValueError("Tour must start with at least one node")
+    succ = {}  # Node -> next node in tour
+    for i in range(len(tour)):
+        succ[tour[i - 1]] = tour[i]
+
+    # Cheapest place to insert node u: between a and succ[a]
+    def cheapest_place(u):
+        row = distance[u]
+        best_cost, best_a = float("inf"), None
+        for a, b in succ.items():
+            cost = distance[a][u] + row[b] - distance[a][b]
+            if cost < best_cost:
+                best_cost, best_a = cost, a
+        return best_cost, best_a
+
+    best = {}  # Node -> (cost, a) of its cheapest place, a is -1 if cost is a lower bound
+    placed_after = {a: set() for a in succ}  # a -> nodes whose cheapest place is after a
+    heap = []
+    for u in remaining:
+        best[u] = cheapest_place(u)
+        placed_after[best[u][1]].add(u)
+        heap.append((best[u][0], u, best[u][1]))
+    heapq.heapify(heap)
+
+    while heap:
+        # Out of time, put every node left at the last place found for it
+        if deadline is not None and time.perf_counter() > deadline:
+            for u, (cost, a) in best.items():
+                if a == -1:
+                    a = tour[0]
+                succ[a], succ[u] = u, succ[a]
+            break
+
+        cost, u, a = heapq.heappop(heap)
+        # Skip entries that are out of date
+        if best.get(u) != (cost, a):
+            continue
+        # Only a lower bound, so find its real cheapest place and try again later
+        if a == -1:
+            best[u] = cheapest_place(u)
+            placed_after[best[u][1]].add(u)
+            heapq.heappush(heap, (best[u][0], u, best[u][1]))
+            continue
+
+        # Insert u between a and b
+        b = succ[a]
+        succ[a] = u
+        succ[u] = b
+        del best[u]
+        placed_after[a].discard(u)
+        lost_place = placed_after[a]  # Nodes whose cheapest place was a -> b
+        placed_after[a] = set()
+        placed_after[u] = set()
+
+        # Only the two new edges a -> u -> b need checking, since every other
+        # place costs at least as much as the node's previous cheapest place
+        for w, (w_cost, w_a) in best.items():
+            row = distance[w]
+            cost_a = distance[a][w] + row[u] - distance[a][u]
+            cost_u = distance[u][w] + row[b] - distance[u][b]
+            new_cost, new_a = (cost_a, a) if cost_a <= cost_u else (cost_u, u)
+            if new_cost < w_cost or (w in lost_place and new_cost == w_cost):
+                best[w] = (new_cost, new_a)
+                if w_a != -1:
+                    placed_after[w_a].discard(w)
+                placed_after[new_a].add(w)
+                heapq.heappush(heap, (new_cost, w, new_a))
+            elif w in lost_place:
+                # Its place is gone, the old cost is now only a lower bound
+                best[w] = (w_cost, -1)
+                heapq.heappush(heap, (w_cost, w, -1))
+
+    # Follow the links to get the tour in order
+    ordered = [tour[0]]
+    while len(ordered) < len(succ):
+        ordered.append(succ[ordered[-1]])
+    return ordered
+
+
+# Local search over a symmetric distance matrix, returns the improved tour
+# tour: list of positions, distance[i][j]: distance between positions i and j
+# moves: "2opt" (reverse part of the tour) and/or "oropt" (move a run of 1-3
+#   nodes elsewhere, either way round, which is the segment insertion 3-opt move)
+# candidates: only try joining a node to its this many nearest nodes
+# Nodes whose surroundings haven't changed since they last failed to improve
+# are skipped ("don't look bits"), so each pass only looks at changed areas
+# deadline: time.perf_counter() value to stop looking at
+def improve_tour(tour: list, distance, moves=("2opt", "oropt"), candidates=8, deadline=None):
+    for move in moves:
+        if move not in ("2opt", "oropt"):
+            raise ValueError("Unknown move '" + str(move) + "'")
+    n = len(tour)
+    if n < 5:
+        return list(tour)
+    tour = list(tour)
+    eps = 1e-9  # Ignore float noise, so equal swaps can't loop forever
+
+    # Nearest nodes to each node, closest first
+    candidates = min(candidates, n - 1)
+    neighbors = []
+    for i in range(n):
+        row = distance[i]
+        nearest = heapq.nsmallest(candidates + 1, range(n), key=row.__getitem__)
+        neighbors.append([j for j in nearest if j != i][:candidates])
+
+    position = [0] * n  # Node -> index in tour
+    for index, node in enumerate(tour):
+        position[node] = index
+
+    def succ(node):
+        return tour[(position[node] + 1) % n]
+
+    def pred(node):
+        return tour[position[node] - 1]
+
+    # Reverse tour from index i to index j (inclusive, wrapping around the end)
+    def reverse(i, j):
+        length = (j - i) % n + 1
+        # Reversing the other side of the tour gives the same cycle
+        if length * 2 > n:
+            i, j = (j + 1) % n, (i - 1) % n
+            length = n - length
+        for step in range(length // 2):
+            a, b = (i + step) % n, (j - step) % n
+            tour[a], tour[b] = tour[b], tour[a]
+            position[tour[a]] = a
+            position[tour[b]] = b
+
+    def try_2opt(a):
+        for forward in (True, False):
+            b = succ(a) if forward else pred(a)
+            d_ab = distance[a][b]
+            for c in neighbors[a]:
+                d_ac = distance[a][c]
+                # Joining a to anything further can't be shorter
+                if d_ac >= d_ab:
+                    break
+                d = succ(c) if forward else pred(c)
+                if c == b or d == a:
+                    continue
+                change = d_ac + distance[b][d] - d_ab - distance[c][d]
+                if change < -eps:
+                    # Swap edges (a, b) and (c, d) for (a, c) and (b, d)
+                    if forward:
+                        reverse(position[b], position[c])
+                    else:
+                        reverse(position[c], position[b])
+                    return (a, b, c, d)
+        return None
+
+    def try_oropt(a):
+        for length in (1, 2, 3):
+            if length > n - 3:
+                break
+            start = position[a]
+            segment = [tour[(start + k) % n] for k in range(length)]
+            last = segment[-1]
+            before, after = pred(a), succ(last)
+            # Saved by cutting the segment out and joining its ends
+            removed = distance[before][a] + distance[last][after] - distance[before][after]
+            if removed <= eps:
+                continue
+
+            in_segment = set(segment)
+            for end, other in ((a, last), (last, a)):
+                for c in neighbors[end]:
+                    if distance[end][c] >= removed:
+                        break
+                    if c in in_segment:
+                        continue
+                    # Put the segment next to c, with `end` touching c
+                    for x, y, first in ((c, succ(c), end), (pred(c), c, other)):
+                        if x in in_segment or y in in_segment:
+                            continue
+                        second = other if first == end else end
+                        added = distance[x][first] + distance[second][y] - distance[x][y]
+                        if added - removed < -eps:
+                            # Cut the segment out, then insert it between x and y
+                            rest = tour[start:] + tour[:start]
+                            del rest[:length]
+                            at = rest.index(x) + 1
+                            rest[at:at] = segment if first == a else segment[::-1]
+                            tour[:] = rest
+                            for index, node in enumerate(tour):
+                                position[node] = index
+                            return (a, last, before, after, x, y)
+        return None
+
+    # Queue of nodes to look at, each node is in it at most once
+    queue = deque(tour)
+    queued = [True] * n
+    while queue:
+        if deadline is not None and time.perf_counter() > deadline:
+            break
+        a = queue.popleft()
+        queued[a] = False
+
+        changed = None
+        if "2opt" in moves:
+            changed = try_2opt(a)
+        if changed is None and "oropt" in moves:
+            changed = try_oropt(a)
+        if changed is None:
+            continue
+
+        # Look again at every node next to a changed edge
+        for node in changed:
+            for near in (node, pred(node), succ(node)):
+                if not queued[near]:
+                    queued[near] = True
+                    queue.append(near)
+
+    return tour
+
+
+# Finds a short tour visiting every node of the matrix, starting closest to start_point
+# moves/candidates: see improve_tour
+# Returns (tour, tour_lenght), where the tour is node ids and ends back at its start
+# seed: if given, the first three nodes are picked at random from this seed
+def build_flight_path(
+    matrix: DistanceMatrix, start_point: tuple, moves=("2opt", "oropt"), candidates=8, seed=None
+):
+    distance = matrix.rows  # distance[i][j] between positions i and j
+
+    to_vist = set(matrix.nodes)
+    if len(to_vist) < 3:
+        raise ValueError("Graph must have at least 3 vertices")
+
+    # Add any three points to tour and vist them
+    # (the tour holds positions in the matrix, not node ids)
+    if seed is None:
+        tour = [matrix.position[to_vist.pop()] for loops in range(3)]
+    else:
+        tour = random.Random(seed).sample(range(len(matrix)), 3)
+    in_tour = set(tour)
+    tour = cheapest_insertion_tour(
+        tour, [i for i in range(len(matrix)) if i not in in_tour], distance
+    )
+
+    # Improve tour with local search, until no more improvement made
+    tour = improve_tour(tour, distance, moves, candidates)
+
+    # Find closest to the start point
+    to_start = matrix.distances_to(*start_point)
+    closest = min(tour, key=to_start.__getitem__)
+
+    # Rotate list, until front is closest
+    front = tour.index(closest)
+    tour = tour[front:] + tour[:front]
+
+    tour.append(tour[0])    # Tour must end at start
+
+    tour_lenght = 0
+    for i in range(len(tour)-1):
+        tour_lenght += distance[tour[i]][tour[i+1]]
+
+    return tuple(matrix.nodes[i] for i in tour), tour_lenght
+
+
+# Distance matrix of the region, built once per worker process
+flight_worker_matrix = None
+
+
+def init_flight_worker(nodes: list, xs, ys):
+    global flight_worker_matrix
+    flight_worker_matrix = DistanceMatrix(nodes, xs, ys)
+
+
+# One run of multistart_flight_path, returns (seed, tour, lenght, seconds)
+def run_flight_worker(seed: int, start_point: tuple, moves, candidates):
+    start = time.perf_counter()
+    tour, lenght = build_flight_path(
+        flight_worker_matrix, start_point, moves, candidates, seed
+    )
+    return seed, tour, lenght, time.perf_counter() - start
+
+
+# Runs build_flight_path from `starts` different random seeds and keeps the shortest
+# Runs are spread over `workers` processes (None: one per CPU, 1: no extra processes),
+# each worker is sent the coordinates once and builds its own DistanceMatrix
+# Seeds come from `seed`, so the same arguments always give the same result
+# Returns (tour, tour_lenght, runs), runs being [{"seed", "lenght", "seconds"}, ...]
+def multistart_flight_path(
+    nodes: list,
+    xs,
+    ys,
+    start_point: tuple,
+    starts=8,
+    workers=None,
+    seed=0,
+    moves=("2opt", "oropt"),
+    candidates=8,
+):
+    if starts < 1:
+        raise ValueError("Need at least one start")
+    rng = random.Random(seed)
+    seeds = [rng.randrange(2**32) for loops in range(starts)]
+    xs, ys = array("d", xs), array("d", ys)
+
+    if workers == 1:
+        init_flight_worker(nodes, xs, ys)
+        results = [run_flight_worker(run_seed, start_point, moves, candidates) for run_seed in seeds]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=init_flight_worker, initargs=(nodes, xs, ys)
+        ) as pool:
+            futures = [
+                pool.submit(run_flight_worker, run_seed, start_point, moves, candidates)
+                for run_seed in seeds
+            ]
+            results = [future.result() for future in futures]
+
+    # Shortest tour, the earliest run if tied
+    best = min(range(starts), key=lambda run: (results[run][2], run))
+    runs = [
+        {"seed": run_seed, "lenght": lenght, "seconds": seconds}
+        for run_seed, tour, lenght, seconds in results
+    ]
+    return results[best][1], results[best][2], runs
+
+
+# Graph used by chemical_source_batch's worker processes, set by init_contamination_worker
+contamination_worker_graph = None
+
+
+def init_contamination_worker(graph: Graph):
+    global contamination_worker_graph
+    contamination_worker_graph = graph
+
+
+# One query of chemical_source_batch, returns (sources, seconds)
+def run_contamination_worker(input_sequence):
+    start = time.perf_counter()
+    sources = contamination_worker_graph.chemical_source(input_sequence, verbose=False)
+    return sources, time.perf_counter() - start
+
+
+
+# Strongly connected components of a directed graph, using Tarjan's algorithm
+# with an explicit stack (no recursion limit)
+# successors(node) gives the nodes it has an edge towards
+# Components come out in reverse topological order: no edge leads from a
+# component to one listed after it
+def strongly_connected_components(nodes, successors):
+    index = {}  # Node -> order the search reached it in
+    lowlink = {}  # Node -> lowest index reachable from its subtree
+    on_stack = set()
+    stack = []
+    components = []
+
+    for root in nodes:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        search = [(root, iter(successors(root)))]
+        while search:
+            node, neighbors = search[-1]
+            for neighbor in neighbors:
+                if neighbor not in index:
+                    index[neighbor] = lowlink[neighbor] = len(index)
+                    stack.append(neighbor)
+                    on_stack.add(neighbor)
+                    search.append((neighbor, iter(successors(neighbor))))
+                    break
+                if neighbor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[neighbor])
+            else:
+                # Every neighbor searched
+                search.pop()
+                if search:
+                    parent = search[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                # Node is the root of a component
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component[::-1])
+    return components
+
+
+# Yields every elementary cycle (no repeated node) of a directed graph once,
+# as a tuple that starts and ends on the same node, e.g. (1, 2, 3, 1)
+# Johnson's algorithm: cycles through each start node are searched for inside
+# its strongly connected component, then the start node is removed
+# max_length: longest cycle (in edges) to yield, None for no limit. Johnson's
+# blocking doesn't hold with a limit, so a bounded search is used instead
+def iter_elementary_cycles(nodes, successors, max_length=None):
+    if max_length is not None and max_length < 1:
+        return
+    nodes = list(dict.fromkeys(nodes))
+    in_graph = set(nodes)
+    # Drop repeated edges, and edges to nodes that aren't in the graph
+    graph = {
+        node: list(dict.fromkeys(w for w in successors(node) if w in in_graph))
+        for node in nodes
+    }
+
+    # Self loops are the cycles of lenght 1
+    for node in nodes:
+        if node in graph[node]:
+            yield (node, node)
+            graph[node] = [w for w in graph[node] if w != node]
+
+    components = [
+        component
+        for component in strongly_connected_components(nodes, graph.__getitem__)
+        if len(component) > 1
+    ]
+    while components:
+        component = components.pop()
+        members = set(component)
+        subgraph = {node: [w for w in graph[node] if w in members] for node in component}
+        start = component[0]
+
+        if max_length is None:
+            yield from johnson_cycle_search(subgraph, start)
+        else:
+            yield from bounded_cycle_search(subgraph, start, max_length)
+
+        # Every cycle through start has been found, so carry on without it
+        del subgraph[start]
+        for node in subgraph:
+            subgraph[node] = [w for w in subgraph[node] if w != start]
+        components.extend(
+            sub_component
+            for sub_component in strongly_connected_components(subgraph, subgraph.__getitem__)
+            if len(sub_component) > 1
+        )
+
+
+# Yields the cycles through start in a strongly connected graph ({node: [node, ...]})
+# Nodes that can't currently reach start stay blocked until a cycle is found
+# through a node they lead to, so dead ends aren't searched again
+def johnson_cycle_search(graph, start):
+    path = [start]
+    blocked = {start}
+    blocked_by = defaultdict(set)  # Node -> blocked nodes to unblock with it
+    found_cycle = [False]  # Whether a cycle was found under each node of path
+    search = [iter(graph[start])]
+    while search:
+        for neighbor in search[-1]:
+            if neighbor == start:
+                yield tuple(path) + (start,)
+                found_cycle[-1] = True
+            elif neighbor not in blocked:
+                path.append(neighbor)
+                found_cycle.append(False)
+                search.append(iter(graph[neighbor]))
+                blocked.add(neighbor)
+                break
+        else:
+            # Every neighbor searched, step back
+            search.pop()
+            node = path.pop()
+            if found_cycle.pop():
+                if found_cycle:
+                    found_cycle[-1] = True
+                # Unblock node, and everything waiting on it
+                unblock = [node]
+                while unblock:
+                    member = unblock.pop()
+                    if member in blocked:
+                        blocked.discard(member)
+                        unblock.extend(blocked_by.pop(member, ()))
+            else:
+                for neighbor in graph[node]:
+                    blocked_by[neighbor].add(node)
+
+
+# Yields the cycles through start of at most max_length edges, by a depth
+# first search that never steps onto a node already on the path
+def bounded_cycle_search(graph, start, max_length):
+    path = [start]
+    on_path = {start}
+    search = [iter(graph[start])]
+    while search:
+        for neighbor in search[-1]:
+            if neighbor == start:
+                yield tuple(path) + (start,)
+            elif neighbor not in on_path and len(path) < max_length:
+                path.append(neighbor)
+                on_path.add(neighbor)
+                search.append(iter(graph[neighbor]))
+                break
+        else:
+            search.pop()
+            on_path.discard(path.pop())
+
+
 # Returns all steps in a LinkedList as an array
 def LL_as_array(LinkedList):
     if not hasattr(LinkedList, "next"):
@@ -1057,41 +2857,42 @@ def validate_coordinate(x_coord, y_coord):
     return x_flag and y_flag
 
 
-# Create a Graph object
-graph = Graph()
-# Parse the CSV file's data into graph's adjacency list
-parse_csv_into_adjacency_list(graph)
+if __name__ == "__main__":
+    # Create a Graph object
+    graph = Graph()
+    # Parse the CSV file's data into graph's adjacency list
+    parse_csv_into_adjacency_list(graph)
 
-# Populate the distance and flow rate of all paths
-graph.populate_distance()
-graph.populate_flow_rate()
+    # Populate the distance and flow rate of all paths
+    graph.populate_distance()
+    graph.populate_flow_rate()
 
 
-### Assignment 3.3
-# QUESTION 1: "Find cycles"
-print("Cycles:")
-for cycle in graph.list_cycles():
-    print(f"\t{cycle}")
+    ### Assignment 3.3
+    # QUESTION 1: "Find cycles"
+    print("Cycles:")
+    for cycle in graph.list_cycles():
+        print(f"\t{cycle}")
 
-# QUESTION 2: "Provide flight path"
-flight_path, flight_lenght = graph.flight_path((0,0), (650,650))
-print(f"\nFlight path: {flight_path} \nLenght: {round(flight_lenght,2)}\n")
+    # QUESTION 2: "Provide flight path"
+    flight_path, flight_lenght = graph.flight_path((0,0), (650,650))
+    print(f"\nFlight path: {flight_path} \nLenght: {round(flight_lenght,2)}\n")
 
-# QUESTION 3: "Likely source of chemical"
-print(graph.chemical_source([(58,3),(55,10),(52,5)]))  # Expected: [25]
-print(graph.chemical_source([(57, 10), (56, 5), (55, 2)]))  # Expected: [22, 21]
-print("")
+    # QUESTION 3: "Likely source of chemical"
+    print(graph.chemical_source([(58,3),(55,10),(52,5)]))  # Expected: [25]
+    print(graph.chemical_source([(57, 10), (56, 5), (55, 2)]))  # Expected: [22, 21]
+    print("")
 
-# QUESTION 4: "Trie of river names"
-river_trie = Trie(("PineCreek",))
+    # QUESTION 4: "Trie of river names"
+    river_trie = Trie(("PineCreek",))
 
-#   River isn't in Trie yet
-river_to_find = "DalyRiver"
-print(f"Is '{river_to_find}' in Trie? {river_to_find in river_trie}")
+    #   River isn't in Trie yet
+    river_to_find = "DalyRiver"
+    print(f"Is '{river_to_find}' in Trie? {river_to_find in river_trie}")
 
-#   Insert river then test again
-river_trie.insert_word(river_to_find)
-print(f"Is '{river_to_find}' in Trie? {river_to_find in river_trie}")
+    #   Insert river then test again
+    river_trie.insert_word(river_to_find)
+    print(f"Is '{river_to_find}' in Trie? {river_to_find in river_trie}")
 
-for word_to_encode in ("DalyRiver", "PineCreek"):
-    print(f"Encoded string for '{word_to_encode}': {river_trie.encode_word(word_to_encode)}")
\ No newline at end of file
+    for word_to_encode in ("DalyRiver", "PineCreek"):
+        print(f"Encoded string for '{word_to_encode}': {river_trie.encode_word(word_to_encode)}")
\ No newline at end of file
@@ -0,0 +1,27 @@
+# Strongly connected components and the condensation of the graph
+from data_struct import Edge, Graph
+
+
+def cyclic_graph():
+    graph = Graph()
+    for node_id in range(1, 6):
+        graph.add_node({"node_id": node_id, "x": node_id, "y": 0, "type": "junction"})
+    graph.add_edges(1, [2])
+    graph.add_edges(2, [3, 99])  # 99 isn't added yet
+    graph.add_edges(3, [2, 4])
+    graph.add_edges(4, [5])
+    return graph
+
+
+def test_components_skip_edges_to_missing_nodes():
+    graph = cyclic_graph()
+    components = [sorted(component) for component in graph.strongly_connected_components()]
+    assert components == [[1], [2, 3], [4], [5]]
+
+
+def test_condensation_skips_edges_to_missing_nodes():
+    graph = cyclic_graph()
+    graph.add_edge(5, Edge(98))
+    condensation = graph.condensation()
+    assert len(condensation) == 4
+    assert list(condensation.successors(condensation.component(2))) == [condensation.component(4)]
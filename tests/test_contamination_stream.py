@@ -0,0 +1,28 @@
+# ContaminationStream must give the same answer as solving its window from scratch
+import random
+
+from data_struct import ContaminationStream, Graph, parse_csv_into_adjacency_list
+
+
+def test_matches_chemical_source():
+    graph = Graph()
+    parse_csv_into_adjacency_list(graph)
+    nodes = [
+        node_id
+        for node_id, vertex in graph.adjacency_list.items()
+        if vertex.type in ("junction", "flowgauge", "headwater")
+    ]
+    on_path = graph.traverse_to_final_outlet(25)
+
+    for seed, window, pool in ((0, 10, on_path), (1, 20, nodes), (2, 10, nodes)):
+        rng = random.Random(seed)
+        stream = ContaminationStream(graph, window)
+        timestamp = 0
+        for loops in range(150):
+            timestamp += rng.randint(0, 4)
+            stream.add(rng.choice(pool), rng.randint(1, 10), timestamp)
+
+            sequence = stream.observations()
+            assert stream.coverage == graph.observation_coverage([node for node, conc in sequence])
+            assert stream.sources() == graph.chemical_source(sequence, verbose=False)
+            assert stream.candidates() == graph.chemical_source_candidates(sequence, verbose=False)
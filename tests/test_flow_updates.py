@@ -0,0 +1,172 @@
+# Incremental flow updates (add_node, add_edges, remove_edge, set_source_flow)
+# must leave the same flows as running populate_flow_rate from scratch, as
+# must FrozenGraph.populate_flow_rate
+import random
+
+from data_struct import Edge, Graph
+
+types = ("headwater", "junction", "flowgauge", "Roadjunction")
+
+
+# Fresh copy of the graph (same nodes and edge order) with flows populated
+def repopulated(graph: Graph):
+    fresh = Graph()
+    for node_id, vertex in graph.adjacency_list.items():
+        fresh.add_node({"node_id": node_id, "x": vertex.x, "y": vertex.y, "type": vertex.type})
+    for node_id in graph.adjacency_list:
+        fresh.add_edges(node_id, [Edge(edge.node) for edge in graph.edges(node_id)])
+    fresh.source_flows = dict(graph.source_flows)
+    fresh.populate_flow_rate(graph.source_flow)
+    return fresh
+
+
+def assert_same_flows(graph: Graph):
+    fresh = repopulated(graph)
+    assert graph.node_flow == fresh.node_flow
+    for node_id in graph.adjacency_list:
+        edges = [(edge.node, edge.flow_rate) for edge in graph.river_edges(node_id)]
+        expected = [(edge.node, edge.flow_rate) for edge in fresh.river_edges(node_id)]
+        assert edges == expected
+
+
+def add_node(graph: Graph, node_id: int, type: str):
+    graph.add_node({"node_id": node_id, "x": node_id % 50, "y": node_id // 50, "type": type})
+
+
+def test_edge_added_before_its_node():
+    graph = Graph()
+    add_node(graph, 1, "junction")
+    add_node(graph, 25, "headwater")
+    graph.add_edge(25, Edge(1))
+    graph.populate_flow_rate()
+
+    graph.add_edge(25, Edge(999))
+    add_node(graph, 999, "junction")
+    graph.add_edge(999, Edge(1))
+
+    assert graph.node_flow[999] == 1
+    assert [edge.flow_rate for edge in graph.river_edges(999)] == [1]
+    assert_same_flows(graph)
+
+
+def test_batch_of_edges():
+    graph = Graph()
+    for node_id in range(6):
+        add_node(graph, node_id, "headwater" if node_id < 3 else "junction")
+    graph.populate_flow_rate()
+
+    graph.add_edges(0, [3, 4])
+    graph.add_edges(1, [Edge(3), Edge(5)])
+    graph.add_edges(3, [5, 5])
+    assert_same_flows(graph)
+
+
+def test_removing_river_breaks_cycle():
+    graph = Graph()
+    add_node(graph, 1, "headwater")
+    for node_id in (2, 3, 4):
+        add_node(graph, node_id, "junction")
+    graph.add_edge(1, Edge(2))
+    graph.add_edge(2, Edge(3))
+    graph.add_edge(3, Edge(2))
+    graph.add_edge(3, Edge(4))
+    graph.populate_flow_rate()
+    assert graph.node_flow == {1: 1}
+
+    graph.remove_edge(3, 2)
+    assert graph.node_flow == {1: 1, 2: 1, 3: 1, 4: 1}
+    assert_same_flows(graph)
+
+    graph.populate_flow_rate()
+    assert graph.node_flow == {1: 1, 2: 1, 3: 1, 4: 1}
+
+# River edge flows of a frozen copy of the graph, after populating its flows
+def frozen_flows(graph: Graph):
+    frozen = graph.freeze()
+    frozen.populate_flow_rate(graph.source_flow)
+    flows = []
+    for i, node_id in enumerate(frozen.node_ids):
+        for slot, j in frozen.edge_slots(i):
+            if frozen.river[slot]:
+                flows.append((node_id, frozen.node_ids[j], frozen.flow_rates[slot]))
+    return flows
+
+
+def river_flows(graph: Graph):
+    return [
+        (node_id, edge.node, edge.flow_rate)
+        for node_id in graph.adjacency_list
+        for edge in graph.river_edges(node_id)
+    ]
+
+
+def test_frozen_graph_source_flows():
+    graph = Graph()
+    add_node(graph, 1, "junction")
+    add_node(graph, 2, "junction")
+    add_node(graph, 3, "headwater")
+    add_node(graph, 4, "junction")
+    graph.add_edges(1, [2])
+    graph.add_edges(3, [2])
+    graph.add_edges(2, [4])
+    graph.populate_flow_rate()
+    graph.set_source_flow(3, 5)
+    assert frozen_flows(graph) == river_flows(graph) == [(1, 2, 0), (2, 4, 5), (3, 2, 5)]
+
+
+def test_frozen_graph_random():
+    for seed in range(50):
+        rng = random.Random(seed)
+        graph = Graph()
+        for node_id in range(15):
+            add_node(graph, node_id, rng.choice(types))
+        for loops in range(25):
+            source = rng.randrange(14)
+            graph.add_edges(source, [rng.randrange(source + 1, 15)])
+        for loops in range(3):
+            graph.source_flows[rng.randrange(15)] = rng.randint(0, 5)
+        graph.populate_flow_rate(rng.randint(1, 3))
+        assert frozen_flows(graph) == river_flows(graph)
+
+def test_random_changes():
+    for seed in range(100):
+        rng = random.Random(seed)
+        graph = Graph()
+        nodes = 12
+        for node_id in range(nodes):
+            add_node(graph, node_id, rng.choice(types))
+        graph.populate_flow_rate()
+
+        next_id = nodes
+        for step in range(40):
+            action = rng.random()
+            if action < 0.5:
+                # Edges only go from lower to higher ids, so rivers can't form a cycle
+                source = rng.randrange(next_id - 1)
+                graph.add_edges(
+                    source,
+                    [rng.randrange(source + 1, next_id + 2) for loops in range(rng.randint(1, 3))],
+                )
+            elif action < 0.7:
+                # May already have edges pointing at it
+                if next_id not in graph.adjacency_list:
+                    add_node(graph, next_id, rng.choice(types))
+                next_id += 1
+            elif action < 0.85:
+                source = rng.randrange(next_id)
+                if source in graph.adjacency_list:
+                    edges = list(graph.neighbors(source))
+                    if edges:
+                        graph.remove_edge(source, rng.choice(edges))
+            else:
+                node_id = rng.randrange(next_id)
+                if node_id in graph.adjacency_list:
+                    graph.set_source_flow(node_id, rng.randint(0, 5))
+
+            # Edges can point at nodes that don't exist yet, only check once they all do
+            if all(
+                edge.node in graph.adjacency_list
+                for node_id in graph.adjacency_list
+                for edge in graph.edges(node_id)
+            ):
+                assert_same_flows(graph)
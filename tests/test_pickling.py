@@ -0,0 +1,70 @@
+# Graphs and vertices sent to a fresh interpreter (the "spawn" start method,
+# the default on Windows and macOS) must keep their node types
+import multiprocessing
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+from data_struct import Graph, Vertex, intern_vertex_type, parse_csv_into_adjacency_list
+
+
+def vertex_type(vertex: Vertex):
+    return vertex.type
+
+
+def node_types(graph: Graph):
+    return {node_id: graph.data(node_id).type for node_id in graph.adjacency_list}
+
+
+def river_edges(graph: Graph):
+    return [(node_id, edge.node) for node_id in graph.adjacency_list for edge in graph.river_edges(node_id)]
+
+
+def load_graph():
+    # Intern extra types first, so this process's type codes differ from a fresh one's
+    intern_vertex_type("test type a")
+    intern_vertex_type("test type b")
+    graph = Graph()
+    parse_csv_into_adjacency_list(graph)
+    return graph
+
+
+def test_types_survive_pickle_in_a_fresh_process():
+    graph = load_graph()
+    graph.river_edges(1)  # Fill river_type_cache
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        assert pool.submit(vertex_type, graph.data(25)).result() == "headwater"
+        assert pool.submit(node_types, graph).result() == node_types(graph)
+        assert pool.submit(river_edges, graph).result() == river_edges(graph)
+
+
+def test_graph_round_trip():
+    graph = load_graph()
+    copy = pickle.loads(pickle.dumps(graph))
+    assert node_types(copy) == node_types(graph)
+    assert river_edges(copy) == river_edges(graph)
+
+
+def test_high_degree_node_round_trip():
+    graph = load_graph()
+    for node_id in range(1000, 3000):
+        graph.add_node({"node_id": node_id, "x": node_id % 650, "y": node_id // 650, "type": "junction"})
+    graph.add_edges(1000, range(1001, 3000))
+    copy = pickle.loads(pickle.dumps(graph))
+    assert list(copy.neighbors(1000)) == list(range(1001, 3000))
+    assert copy.data(1000).degree == 1999
+    assert copy.data(1000).tail.node == 2999
+    assert river_edges(copy) == river_edges(graph)
+
+
+def test_chemical_source_batch_under_spawn():
+    graph = load_graph()
+    for node_id in range(1000, 1500):
+        graph.add_node({"node_id": node_id, "x": node_id % 650, "y": 0, "type": "junction"})
+    graph.add_edges(25, range(1000, 1500))  # Node with far more edges than the recursion limit allows for
+    sequences = [[(25, 10), (27, 8)], [(40, 9), (28, 7), (1, 3)], [(16, 5), (4, 2)]]
+    expected = [graph.chemical_source(sequence, verbose=False) for sequence in sequences]
+    results = graph.chemical_source_batch(
+        sequences, workers=2, mp_context=multiprocessing.get_context("spawn")
+    )
+    assert [result["sources"] for result in results] == expected